@@ -1,15 +1,38 @@
 import streamlit as st
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
 import pandas as pd
 import requests
 import xml.etree.ElementTree as ET
 import re
 import os
+import math
+import heapq
+import bisect
 import time
+import json
+import hashlib
+import uuid
+import tempfile
+import sqlite3
+import difflib
+import atexit
 import datetime
+import unicodedata
+import mmap
+import threading
+import queue
+import multiprocessing
+import functools
+import contextlib
+import logging
+import logging.handlers
 import PyPDF2
 from docx import Document
+from pdf_worker import extract_pdf_pages
 from io import BytesIO
+from collections import deque, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, BrokenExecutor, CancelledError, as_completed, wait, FIRST_COMPLETED
 
 # ==========================================
 # 1. KONFIGURASI SISTEM
@@ -27,6 +50,55 @@ try:
         API_KEYS_POOL = st.secrets["api_keys"]
 except: pass
 
+# --- METRIK PERFORMA ---
+RUN_T0 = time.perf_counter()
+METRICS_FILE = "metrics.jsonl"
+METRICS_MAX_BYTES = 5 * 1024 * 1024
+METRICS_BACKUPS = 3
+METRICS_PANEL_ROWS = 20000     # baris terakhir yang dibaca panel metrik
+ADMIN_USERS = []            # user yang boleh melihat panel metrik (st.secrets["admin"])
+try: ADMIN_USERS = list(st.secrets["admin"])
+except: pass
+
+# --- PENJADWAL KEY ---
+KEY_COOLDOWN_SEC = 60   # key diistirahatkan setelah kena 429/quota
+KEY_RPM_BUDGET = 15     # jatah request per key per menit
+KEY_WAIT_MAX_SEC = 180  # batas tunggu satu generate saat semua key hanya tertahan jatah RPM/cooldown
+BATCH_RETRIES = 2       # retry per sub-bab di mode "Tulis Semua"
+BATCH_RETRY_SEC = 5
+MODEL_PREFERENCE = "flash"
+MODEL_FALLBACK = "models/gemini-flash-latest"   # dipakai kalau list_models gagal / tidak ada model MODEL_PREFERENCE
+MODEL_LOOKUP_RETRY_SEC = 300    # list_models yang gagal (bukan kuota) baru dicoba lagi setelah ini
+
+# --- ANTRIAN GENERATE (lintas sesi) ---
+LLM_WORKERS = 8             # generate yang jalan bersamaan di seluruh proses
+LLM_USER_CONCURRENCY = 2    # generate interaktif bersamaan per user
+LLM_BATCH_CONCURRENCY = 4   # generate batch (Tulis Semua, ringkasan) bersamaan per user, jatah terpisah
+LLM_USER_QUEUE = 30         # antrian maksimal per user
+LLM_QUEUE_POLL_SEC = 0.5    # interval update posisi antrian di UI
+
+# --- CACHE RESPON AI ---
+LLM_CACHE_TTL = 30 * 24 * 3600
+LLM_CACHE_MAX_ENTRIES = 2000
+
+# --- RINGKASAN BAB (konteks lintas bab) ---
+SUMMARY_SECTION_WORDS = 80      # ringkasan per sub-bab; sub-bab sependek ini dipakai apa adanya
+SUMMARY_CHAPTER_WORDS = 150     # ringkasan per bab (hasil gabungan ringkasan sub-bab)
+CHAPTER_KEYS = ['naskah_bab1', 'naskah_bab2', 'naskah_bab3', 'naskah_bab4', 'naskah_bab5']
+
+# --- PENCARIAN ---
+PUBMED_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+CROSSREF_URL = "https://api.crossref.org/works"
+SEARCH_TIMEOUT = {"PubMed": 25, "Crossref": 20}   # batas tunggu per sumber (detik)
+SEARCH_CACHE_TTL = 6 * 3600
+PUBMED_BATCH = 20       # jumlah record per request esummary
+CROSSREF_PAGE_ROWS = 20     # ukuran halaman minimal Crossref (halaman = max(limit, ini))
+CROSSREF_MAX_PAGES = 10     # batas halaman per pencarian (filter ketat + hasil sedikit)
+LIBRARY_SEARCH_LIMIT = 200  # baris maksimal hasil cari di pustaka lokal
+TITLE_FP_MIN_WORDS = 4      # judul lebih pendek (mis. "Editorial") tidak dipakai untuk dedup
+PLACEHOLDER_TITLES = ("no title", "untitled")
+CACHE_DIR = ".cache"
+
 st.markdown("""
 <style>
     .main-header {font-size: 2.2rem; font-weight: 800; color: #1E88E5; margin-bottom: 0px;}
@@ -46,7 +118,47 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-PDF_CACHE_FILE = "cached_pdf_context.txt"
+PDF_CACHE_FILE = "cached_pdf_context.txt"    # format lama, dimigrasi ke corpus store
+
+# --- DATABASE PROYEK ---
+DB_FILE = "thesis_master.db"
+DB_FLUSH_SEC = 1.0          # jeda pengumpulan tulisan sebelum commit ke SQLite
+REVISION_KEYS = ("naskah_", "outline_", "judul_final", "data_penelitian")
+REVISION_LIMIT = 200        # revisi (delta) yang disimpan per naskah
+
+# --- JOB LATAR BELAKANG (PDF, pencarian, tulis) ---
+JOB_IO_WORKERS = 4      # job PDF & pencarian yang jalan bersamaan di seluruh proses (job Tulis: LLM_WORKERS)
+JOB_USER_CONCURRENCY = 2    # job bersamaan per user per jalur; sisanya 'antri' dan dapat giliran round-robin
+JOB_USER_QUEUE = 10     # job antri maksimal per user per jalur
+JOB_LANES = {"tulis": "ai", "tulis_semua": "ai", "pdf": "io", "search": "io"}
+JOB_POLL_SEC = 1.0      # interval panel job memeriksa status
+JOB_SAVE_SEC = 1.0      # progress job ditulis ke SQLite paling sering sekali per interval ini
+STREAM_SAVE_SEC = 2     # interval simpan hasil parsial job (naskah yang sedang di-stream) ke SQLite
+JOB_KEEP_SEC = 24 * 3600    # job yang hasilnya sudah diambil dihapus setelah ini
+
+# --- CORPUS STORE (teks PDF bersama antar user) ---
+CORPUS_DIR = "corpus_store"
+CORPUS_SEGMENT_BYTES = 64 * 1024 * 1024
+CORPUS_CACHE_CHARS = 50_000_000     # batas LRU teks dokumen di RAM
+
+# --- RETRIEVAL (BM25) ---
+CHUNK_CHARS = 2000      # target panjang potongan konteks
+CHUNK_OVERLAP = 300     # overlap antar potongan (mulai di batas kalimat)
+BM25_K1, BM25_B = 1.5, 0.75
+
+# --- KONTEKS PROMPT (token budget) ---
+CONTEXT_BUDGET = {"subbab": 1500, "batch": 1000}   # token konteks (PDF + data/ringkasan) per jenis prompt
+CONTEXT_MIN_TOKENS = 300        # sisa minimal untuk potongan PDF walau data/ringkasan sudah panjang
+CONTEXT_CANDIDATES = 12         # kandidat potongan BM25 sebelum dipilah
+CONTEXT_MIN_SCORE = 0.35        # potongan dengan skor < 35% skor teratas dibuang
+CONTEXT_DUP_SIM = 0.6           # kemiripan (Jaccard 3-gram kata) di atas ini = duplikat
+CONTEXT_CACHE_CHUNKS = 5000     # potongan yang kalimat & jumlah tokennya di-cache
+
+# --- EKSTRAKSI PDF ---
+PDF_MAX_PAGES = 50          # default batas halaman per PDF (bisa diubah di sidebar)
+PDF_PAGES_PER_TASK = 20     # satu task worker = satu rentang halaman
+PDF_WORKERS = max(1, min(4, os.cpu_count() or 1))
+PDF_INFLIGHT = PDF_WORKERS * 2      # task yang dikirim ke pool sekaligus; sisanya menunggu giliran
 
 # ==========================================
 # 2. SISTEM LOGIN
@@ -89,62 +201,680 @@ def get_user_filename(filename):
     safe_user = re.sub(r'[^a-zA-Z0-9]', '_', user)
     return f"{safe_user}_{filename}"
 
-def save_to_disk(filename, content):
-    try:
-        with open(get_user_filename(filename), "w", encoding="utf-8") as f: f.write(str(content))
+@st.cache_resource
+def get_metrics_logger():
+    log = logging.getLogger("thesis_master.metrics")
+    log.setLevel(logging.INFO); log.propagate = False
+    if not log.handlers:
+        h = logging.handlers.RotatingFileHandler(METRICS_FILE, maxBytes=METRICS_MAX_BYTES, backupCount=METRICS_BACKUPS, encoding="utf-8")
+        h.setFormatter(logging.Formatter("%(message)s")); log.addHandler(h)
+    return log
+
+def record_metric(kind, **fields):
+    """Satu baris JSONL per kejadian: latensi (ms), jumlah, error, dsb. Aman dipanggil dari thread mana pun."""
+    try: get_metrics_logger().info(json.dumps({"ts": round(time.time(), 3), "kind": kind, **fields}, default=str))
     except: pass
 
+@contextlib.contextmanager
+def timed(kind, **fields):
+    """Catat durasi blok; isi dict yang di-yield untuk menambah field (hits, pages, ...)."""
+    t0 = time.perf_counter(); extra = {}
+    try: yield extra
+    except Exception as e: extra["error"] = str(e)[:300]; raise
+    finally: record_metric(kind, ms=round((time.perf_counter() - t0) * 1000, 1), **fields, **extra)
+
+def timed_fn(kind):
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(kind, name=fn.__name__): return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def text_delta(new, old):
+    """Delta baris untuk mengembalikan `new` menjadi `old`: [[i1, i2, teks_lama], ...]."""
+    a = new.splitlines(keepends=True); b = old.splitlines(keepends=True)
+    ops = difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes()
+    return [[i1, i2, "".join(b[j1:j2])] for tag, i1, i2, j1, j2 in ops if tag != "equal"]
+
+def apply_delta(new, delta):
+    lines = new.splitlines(keepends=True); out = []; pos = 0
+    for i1, i2, old in delta:
+        out += lines[pos:i1]; out.append(old); pos = i2
+    return "".join(out + lines[pos:])
+
+class ProjectStore:
+    """Data proyek semua user di satu SQLite (WAL). Tulisan dikumpulkan di memori lalu di-commit
+    bersamaan oleh thread flusher; tiap perubahan naskah menyimpan delta balik sebagai revisi."""
+    def __init__(self, path):
+        self.lock = threading.Lock(); self.db_lock = threading.Lock()
+        self.pending = {}; self.wake = threading.Event()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, last_login REAL);
+            CREATE TABLE IF NOT EXISTS project_data (user TEXT, key TEXT, value TEXT, updated REAL, PRIMARY KEY (user, key));
+            CREATE TABLE IF NOT EXISTS revisions (id INTEGER PRIMARY KEY AUTOINCREMENT, user TEXT, key TEXT, ts REAL, delta TEXT);
+            CREATE INDEX IF NOT EXISTS idx_revisions ON revisions (user, key, id);
+        """)
+        threading.Thread(target=self._flusher, daemon=True, name="db-flush").start()
+        atexit.register(self.flush)
+
+    def _flusher(self):
+        while True:
+            self.wake.wait(); time.sleep(DB_FLUSH_SEC); self.wake.clear()
+            try: self.flush()
+            except Exception as e: record_metric("db_error", error=str(e)[:300])
+
+    def put(self, user, key, value):
+        """value=None menghapus key. Ditulis ke disk paling lambat DB_FLUSH_SEC kemudian."""
+        with self.lock: self.pending[(user, key)] = value
+        self.wake.set()
+
+    def flush(self):
+        with self.lock: batch, self.pending = self.pending, {}
+        if not batch: return
+        now = time.time()
+        with self.db_lock, self.conn:
+            for (user, key), value in batch.items():
+                row = self.conn.execute("SELECT value FROM project_data WHERE user=? AND key=?", (user, key)).fetchone()
+                old = row[0] if row else None
+                if old == value: continue
+                if value is None: self.conn.execute("DELETE FROM project_data WHERE user=? AND key=?", (user, key))
+                else: self.conn.execute("INSERT OR REPLACE INTO project_data VALUES (?, ?, ?, ?)", (user, key, value, now))
+                # Key terhapus (None) dihitung "" supaya rantai delta tetap nyambung lewat Reset;
+                # key baru hanya butuh revisi kalau sebelumnya pernah punya riwayat (dihapus lalu ditulis lagi)
+                if any(p in key for p in REVISION_KEYS) and (old is not None or self.conn.execute(
+                        "SELECT 1 FROM revisions WHERE user=? AND key=? LIMIT 1", (user, key)).fetchone()):
+                    self.conn.execute("INSERT INTO revisions (user, key, ts, delta) VALUES (?, ?, ?, ?)",
+                                      (user, key, now, json.dumps(text_delta(value or "", old or ""))))
+                    self.conn.execute("""DELETE FROM revisions WHERE user=? AND key=? AND id NOT IN
+                                         (SELECT id FROM revisions WHERE user=? AND key=? ORDER BY id DESC LIMIT ?)""",
+                                      (user, key, user, key, REVISION_LIMIT))
+
+    def load(self, user):
+        """Semua data proyek user dalam satu query (ditambah tulisan yang belum di-flush)."""
+        with self.db_lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO users VALUES (?, ?)", (user, time.time()))
+            data = dict(self.conn.execute("SELECT key, value FROM project_data WHERE user=?", (user,)).fetchall())
+        with self.lock:
+            for (u, k), v in self.pending.items():
+                if u == user: data[k] = v
+        return {k: v for k, v in data.items() if v is not None}
+
+    def clear(self, user):
+        for k in self.load(user): self.put(user, k, None)
+
+    def history(self, user, key, limit=20):
+        """Versi-versi lama naskah, terbaru dulu: [(timestamp, teks)]."""
+        self.flush()
+        with self.db_lock:
+            cur = self.conn.execute("SELECT value FROM project_data WHERE user=? AND key=?", (user, key)).fetchone()
+            rows = self.conn.execute("SELECT ts, delta FROM revisions WHERE user=? AND key=? ORDER BY id DESC LIMIT ?", (user, key, limit)).fetchall()
+        text = cur[0] if cur else ""; out = []
+        for ts, delta in rows:
+            text = apply_delta(text, json.loads(delta)); out.append((ts, text))
+        return out
+
+@st.cache_resource
+def get_project_store():
+    return ProjectStore(DB_FILE)
+
+def store_key(filename):
+    return re.sub(r'^backup_|\.(txt|json)$', '', filename)
+
+def current_user():
+    return st.session_state.get('username', 'guest')
+
+def save_to_disk(filename, content):
+    get_project_store().put(current_user(), store_key(filename), str(content))
+
 def load_from_disk(filename):
+    if '_project' not in st.session_state: st.session_state['_project'] = get_project_store().load(current_user())
+    data = st.session_state['_project']; key = store_key(filename)
+    if key in data: return data[key]
+    # Migrasi file backup lama (<user>_backup_*.txt) ke database
     unique = get_user_filename(filename)
     if os.path.exists(unique):
-        with open(unique, "r", encoding="utf-8") as f: return f.read()
+        with open(unique, "r", encoding="utf-8") as f: content = f.read()
+        store = get_project_store(); store.put(current_user(), key, content); store.flush()
+        os.remove(unique)
+        data[key] = content
+        return content
     return ""
 
 def delete_file(filename):
+    get_project_store().put(current_user(), store_key(filename), None)
+    st.session_state.get('_project', {}).pop(store_key(filename), None)
     unique = get_user_filename(filename)
     if os.path.exists(unique): os.remove(unique)
 
+def cache_path(namespace, key):
+    return os.path.join(CACHE_DIR, namespace, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+def cache_get(namespace, key, ttl):
+    # TTL dihitung dari waktu tulis; mtime file dipakai sebagai penanda "terakhir dipakai" untuk LRU
+    path = cache_path(namespace, key)
+    try:
+        with open(path, "r", encoding="utf-8") as f: item = json.load(f)
+        if time.time() - item["t"] <= ttl:
+            os.utime(path)
+            return item["v"]
+        os.remove(path)
+    except: pass
+    return None
+
+def cache_put(namespace, key, value, max_entries=None):
+    path = cache_path(namespace, key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f: json.dump({"t": time.time(), "v": value}, f)
+        os.replace(tmp, path)
+        if max_entries:
+            folder = os.path.dirname(path)
+            files = [e for e in os.scandir(folder) if e.name.endswith(".json")]
+            if len(files) > max_entries:
+                files.sort(key=lambda e: e.stat().st_mtime)
+                for e in files[:len(files) - max_entries]: os.remove(e.path)
+    except Exception as e: record_metric("cache_error", namespace=namespace, error=str(e)[:300])
+
+class CorpusStore:
+    """Teks dokumen dialamatkan oleh hash isinya. Segmen append-only, dibaca lewat mmap + LRU."""
+    def __init__(self, root):
+        self.root = root; self.lock = threading.Lock()
+        self.catalog = {}; self.maps = {}
+        self.cache = OrderedDict(); self.cache_chars = 0
+        os.makedirs(root, exist_ok=True)
+        try:
+            with open(os.path.join(root, "catalog.jsonl"), "r", encoding="utf-8") as f:
+                for line in f:
+                    try: e = json.loads(line); self.catalog[e["id"]] = (e["seg"], e["off"], e["len"])
+                    except: pass   # baris terakhir bisa terpotong kalau proses mati saat menulis
+        except OSError: pass
+        self.seg = max([v[0] for v in self.catalog.values()], default=0)
+
+    def seg_path(self, n):
+        return os.path.join(self.root, f"seg_{n:05d}.dat")
+
+    def _remember(self, doc_id, text):
+        if doc_id in self.cache: return
+        self.cache[doc_id] = text; self.cache_chars += len(text)
+        while self.cache_chars > CORPUS_CACHE_CHARS and len(self.cache) > 1:
+            self.cache_chars -= len(self.cache.popitem(last=False)[1])
+
+    def put(self, text):
+        data = text.encode("utf-8")
+        doc_id = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if doc_id in self.catalog: return doc_id
+            path = self.seg_path(self.seg)
+            if os.path.exists(path) and 0 < os.path.getsize(path) and os.path.getsize(path) + len(data) > CORPUS_SEGMENT_BYTES:
+                self.seg += 1; path = self.seg_path(self.seg)
+            with open(path, "ab") as f: off = f.tell(); f.write(data)
+            with open(os.path.join(self.root, "catalog.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"id": doc_id, "seg": self.seg, "off": off, "len": len(data)}) + "\n")
+            self.catalog[doc_id] = (self.seg, off, len(data))
+            self._remember(doc_id, text)
+        return doc_id
+
+    def get(self, doc_id):
+        with self.lock:
+            if doc_id in self.cache:
+                self.cache.move_to_end(doc_id); return self.cache[doc_id]
+            seg, off, n = self.catalog[doc_id]
+            if not n: return ""
+            mm = self.maps.get(seg)
+            if mm is None or off + n > len(mm):
+                if mm is not None: mm.close()
+                with open(self.seg_path(seg), "rb") as f: mm = self.maps[seg] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            text = mm[off:off + n].decode("utf-8")
+            self._remember(doc_id, text)
+        return text
+
+@st.cache_resource
+def get_corpus_store():
+    return CorpusStore(CORPUS_DIR)
+
+class FairQueue:
+    """Antrian bersama semua sesi: worker terbatas, giliran round-robin antar user, dan tiap user punya
+    jatah jalan bersamaan per jalur (`limits`). Dipakai antrian generate (interaktif vs batch, jadi
+    Tulis Semua tidak menghabiskan jatah Tulis/outline user yang sama) dan antrian job."""
+    def __init__(self, workers, limits, queue_max, name, label):
+        self.cond = threading.Condition()
+        self.limits = limits; self.queue_max = queue_max; self.label = label
+        self.queues = OrderedDict()     # user -> deque[(future, fn, jalur)]; urutan = giliran berikutnya
+        self.running = Counter()        # (user, jalur) -> jumlah yang jalan
+        for i in range(workers): threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True).start()
+
+    def submit(self, user, fn, lane):
+        fut = Future()
+        with self.cond:
+            q = self.queues.setdefault(user, deque())
+            if len(q) >= self.queue_max: raise Exception(f"Antrian {self.label} Anda penuh, tunggu permintaan sebelumnya selesai.")
+            q.append((fut, fn, lane)); self.cond.notify()
+        return fut
+
+    def cancel(self, user, fut):
+        """Buang job yang belum jalan (mis. sesi rerun / tombol Batal). Job yang sudah jalan dibiarkan selesai."""
+        with self.cond:
+            q = self.queues.get(user)
+            if q is None: return
+            for item in q:
+                if item[0] is fut: q.remove(item); fut.cancel(); break
+            if not q: del self.queues[user]
+
+    def position(self, user, fut):
+        """Perkiraan jumlah job di depan `fut`; None kalau sudah jalan/selesai."""
+        with self.cond:
+            q = self.queues.get(user, ())
+            i = next((n for n, (f, *_) in enumerate(q) if f is fut), None)
+            if i is None: return None
+            return i + sum(min(len(o), i + 1) for u, o in self.queues.items() if u != user)
+
+    def snapshot(self):
+        with self.cond:
+            users = set(self.queues) | {u for u, _ in self.running}
+            return [{"user": u[:3] + "…", **{f"jalan ({lane})": self.running[u, lane] for lane in self.limits},
+                     "antri": len(self.queues.get(u, ()))} for u in sorted(users)]
+
+    def _next(self):
+        for user, q in self.queues.items():
+            item = next((x for x in q if self.running[user, x[2]] < self.limits[x[2]]), None)
+            if item is None: continue
+            q.remove(item)
+            if q: self.queues.move_to_end(user)
+            else: del self.queues[user]
+            return (user,) + item
+        return None
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                job = self._next()
+                while job is None: self.cond.wait(); job = self._next()
+                user, fut, fn, lane = job
+                self.running[user, lane] += 1
+            try:
+                if fut.set_running_or_notify_cancel():
+                    try: fut.set_result(fn())
+                    except BaseException as e: fut.set_exception(e)
+            finally:
+                with self.cond:
+                    self.running[user, lane] -= 1
+                    if not self.running[user, lane]: del self.running[user, lane]
+                    self.cond.notify_all()
+
+class JobHandle:
+    """Yang dilihat fungsi job: lapor progress/hasil sementara dan cek tombol Batal. Tanpa st.session_state."""
+    def __init__(self, runner, job_id): self.runner = runner; self.id = job_id
+
+    def progress(self, done=None, total=None, message=None):
+        self.runner._update(self.id, None if done is None else done / max(total or 1, 1), message)
+
+    def partial(self, value):
+        """Hasil sementara, bentuknya sama dengan hasil job. Disimpan ke SQLite tiap STREAM_SAVE_SEC dan
+        diterapkan kalau job berakhir tanpa hasil (gagal, dibatalkan, server dimulai ulang)."""
+        self.runner._update(self.id, None, None, value)
+
+    def cancelled(self):
+        return self.id in self.runner.cancels
+
+class JobRunner:
+    """Job latar belakang yang tidak ikut mati saat rerun/refresh: jalan di antrian adil per jalur (ai/io), status & hasil
+    (JSON) disimpan di SQLite. Hasil diterapkan ke sesi user pada rerun berikutnya (lihat apply_finished_jobs)."""
+    ACTIVE = ("antri", "jalan")
+
+    def __init__(self, path, workers):
+        self.lock = threading.Lock()
+        self.live = {}          # job_id -> {"progress", "message", "partial", "saved", "partial_saved"} untuk job di proses ini
+        self.cancels = set()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, user TEXT, kind TEXT, label TEXT, status TEXT,
+                                 progress REAL, message TEXT, result TEXT, error TEXT, created REAL, updated REAL, applied INTEGER DEFAULT 0,
+                                 partial TEXT)""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user, applied)")
+            # Job dari proses sebelumnya (server restart) tidak akan pernah selesai
+            self.conn.execute("UPDATE jobs SET status='gagal', error='Server dimulai ulang', updated=? WHERE status IN ('antri', 'jalan')", (time.time(),))
+            self.conn.execute("DELETE FROM jobs WHERE applied=1 AND updated < ?", (time.time() - JOB_KEEP_SEC,))
+        # Jalur terpisah: Tulis Semua yang memegang thread lama tidak menahan pencarian/PDF user lain
+        self.queues = {lane: FairQueue(n, {lane: JOB_USER_CONCURRENCY}, JOB_USER_QUEUE, f"job-{lane}", "job")
+                       for lane, n in workers.items()}
+
+    def _write(self, sql, args):
+        with self.lock, self.conn: self.conn.execute(sql, args)
+
+    def submit(self, user, kind, label, fn, *args):
+        """fn(job, *args) dijalankan di thread job; nilai kembaliannya (JSON) menjadi hasil job."""
+        job_id = uuid.uuid4().hex[:12]; now = time.time()
+        with self.lock: self.live[job_id] = {"progress": 0.0, "message": "", "partial": None, "saved": 0.0, "partial_saved": 0.0}
+        self._write("INSERT INTO jobs (id, user, kind, label, status, progress, message, created, updated) VALUES (?, ?, ?, ?, 'antri', 0, '', ?, ?)",
+                    (job_id, user, kind, label, now, now))
+        lane = JOB_LANES[kind]
+        try: self.queues[lane].submit(user, lambda: self._run(job_id, kind, fn, args), lane)
+        except Exception:   # antrian user penuh
+            self._write("DELETE FROM jobs WHERE id=?", (job_id,))
+            with self.lock: self.live.pop(job_id, None)
+            raise
+        return job_id
+
+    def _run(self, job_id, kind, fn, args):
+        if job_id in self.cancels:
+            self._finish(job_id, "batal", None, None); return
+        self._write("UPDATE jobs SET status='jalan', updated=? WHERE id=?", (time.time(), job_id))
+        try:
+            with timed("job", name=kind): result = fn(JobHandle(self, job_id), *args)
+            self._finish(job_id, "selesai", json.dumps(result), None)
+        except Exception as e: self._finish(job_id, "gagal", None, str(e)[:500])
+
+    def _finish(self, job_id, status, result, error):
+        with self.lock: partial = self.live.get(job_id, {}).get("partial")
+        partial = None if partial is None else json.dumps(partial)    # versi terakhir, bukan yang tersimpan 2 detik lalu
+        self._write("UPDATE jobs SET status=?, progress=1, result=?, error=?, partial=COALESCE(?, partial), updated=? WHERE id=?",
+                    (status, result, error, partial, time.time(), job_id))
+        with self.lock: self.live.pop(job_id, None); self.cancels.discard(job_id)
+
+    def _update(self, job_id, progress, message, partial=None):
+        now = time.time(); args = pargs = None
+        with self.lock:
+            live = self.live.get(job_id)
+            if live is None: return
+            if progress is not None: live["progress"] = min(1.0, progress)
+            if message is not None: live["message"] = message
+            if partial is not None:
+                live["partial"] = partial
+                if now - live["partial_saved"] >= STREAM_SAVE_SEC: live["partial_saved"] = now; pargs = (json.dumps(partial), job_id)
+            if now - live["saved"] >= JOB_SAVE_SEC: live["saved"] = now; args = (live["progress"], live["message"], now, job_id)
+        if args: self._write("UPDATE jobs SET progress=?, message=?, updated=? WHERE id=?", args)
+        if pargs: self._write("UPDATE jobs SET partial=? WHERE id=?", pargs)
+
+    def cancel(self, user, job_id=None):
+        """Tandai Batal (job_id=None: semua job aktif user). Fungsi job yang memeriksa cancelled() berhenti lebih awal."""
+        with self.lock:
+            ids = [r[0] for r in self.conn.execute("SELECT id FROM jobs WHERE user=? AND status IN ('antri', 'jalan')", (user,))
+                   if job_id is None or r[0] == job_id]
+            self.cancels.update(i for i in ids if i in self.live)
+
+    def active(self, user):
+        """Job user yang belum selesai, digabung progress terbaru dari memori."""
+        with self.lock:
+            rows = self.conn.execute("SELECT id, kind, label, status, progress, message FROM jobs WHERE user=? AND status IN ('antri', 'jalan') ORDER BY created",
+                                     (user,)).fetchall()
+            out = []
+            for job_id, kind, label, status, progress, message in rows:
+                live = self.live.get(job_id, {})
+                out.append({"id": job_id, "kind": kind, "label": label, "status": status, "progress": live.get("progress", progress),
+                            "message": live.get("message", message), "partial": live.get("partial"), "batal": job_id in self.cancels})
+            return out
+
+    def finished(self, user):
+        """Job user yang sudah selesai/gagal tapi hasilnya belum diterapkan ke sesi."""
+        with self.lock:
+            rows = self.conn.execute("SELECT id, kind, label, status, result, error, partial FROM jobs WHERE user=? AND applied=0 AND status NOT IN ('antri', 'jalan') ORDER BY updated",
+                                     (user,)).fetchall()
+        return [{"id": r[0], "kind": r[1], "label": r[2], "status": r[3], "result": json.loads(r[4]) if r[4] else None, "error": r[5],
+                 "partial": json.loads(r[6]) if r[6] else None} for r in rows]
+
+    def mark_applied(self, job_id):
+        self._write("UPDATE jobs SET applied=1 WHERE id=?", (job_id,))
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner(DB_FILE, {"ai": LLM_WORKERS, "io": JOB_IO_WORKERS})
+
 def perform_full_reset():
-    delete_file(PDF_CACHE_FILE)
+    get_job_runner().cancel(current_user())
+    get_project_store().clear(current_user())
+    st.session_state['_project'] = {}
     keys = ['naskah_bab1', 'naskah_bab2', 'naskah_bab3', 'naskah_bab4', 'naskah_bab5',
             'outline_bab1', 'outline_bab2', 'outline_bab3', 'outline_bab4', 'outline_bab5', 
             'judul_final', 'data_penelitian', 'search_results', 'opsi_judul_generated', 'generated_formulas']
     for k in keys:
         if k in st.session_state: st.session_state[k] = "" if 'outline' not in k and 'search' not in k else []
-        delete_file(f"backup_{k}.txt")
-    st.session_state['pdf_context'] = ""
+    st.session_state['pdf_index'] = Bm25Index()
+    st.session_state['pdf_docs'] = []
     return True
 
 # ==========================================
 # 4. AI ENGINE
 # ==========================================
-def get_model():
-    safe = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
-    ]
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
+]
+
+def is_quota_error(e):
+    msg = str(e)
+    return "429" in msg or "quota" in msg.lower()
+
+class KeyScheduler:
+    """Pilih key sehat yang paling sepi; nama model MODEL_PREFERENCE dicari sekali per key."""
+    def __init__(self, keys):
+        self.lock = threading.Lock()
+        self.state = {k: {"model": None, "model_retry": 0.0, "cooldown": 0.0, "inflight": 0, "calls": deque(), "clients": {},
+                          "label": f"key{i + 1}", "errors": deque(maxlen=20)} for i, k in enumerate(keys)}
+
+    def _load(self, s, now):
+        while s["calls"] and now - s["calls"][0] > 60: s["calls"].popleft()
+        return (s["inflight"], len(s["calls"]))
+
+    def acquire(self, exclude=()):
+        with self.lock:
+            now = time.time(); best = None
+            for k, s in self.state.items():
+                if k in exclude or s["cooldown"] > now: continue
+                load = self._load(s, now)
+                if load[1] >= KEY_RPM_BUDGET: continue
+                if best is None or load < best[0]: best = (load, k)
+            if best is None: return None
+            s = self.state[best[1]]
+            s["inflight"] += 1; s["calls"].append(now)
+            return best[1]
+
+    def wait_time(self, exclude=()):
+        """Detik sampai salah satu key (di luar `exclude`) lepas dari cooldown/jatah RPM; None kalau tidak ada key."""
+        with self.lock:
+            now = time.time(); waits = []
+            for k, s in self.state.items():
+                if k in exclude: continue
+                full = self._load(s, now)[1] >= KEY_RPM_BUDGET
+                waits.append(max(s["cooldown"], s["calls"][0] + 60 if full else now) - now)
+            return max(0.0, min(waits)) if waits else None
+
+    def release(self, key, error=None):
+        with self.lock:
+            s = self.state[key]
+            s["inflight"] = max(0, s["inflight"] - 1)
+            if error is None: return
+            s["errors"].append((time.time(), str(error)[:300]))
+            if is_quota_error(error): s["cooldown"] = time.time() + KEY_COOLDOWN_SEC
+
+    def snapshot(self):
+        """Status per key untuk panel metrik (tanpa membocorkan key)."""
+        with self.lock:
+            now = time.time()
+            return [{"key": s["label"], "inflight": s["inflight"], "req/menit": self._load(s, now)[1],
+                     "cooldown (dtk)": max(0, round(s["cooldown"] - now)), "model": s["model"],
+                     "error terakhir": s["errors"][-1][1] if s["errors"] else ""} for s in self.state.values()]
+
+    def client(self, key, service="generative"):
+        """Client gRPC milik satu key. Tidak memakai genai.configure yang global untuk semua sesi."""
+        with self.lock:
+            clients = self.state[key]["clients"]
+            if service not in clients:
+                cls = glm.GenerativeServiceClient if service == "generative" else glm.ModelServiceClient
+                clients[service] = cls(client_options={"api_key": key})
+            return clients[service]
+
+    def model_name(self, key):
+        # Gagal list_models di-cache MODEL_LOOKUP_RETRY_SEC (pakai MODEL_FALLBACK); gagal kuota dilempar
+        # supaya release() di _call mengistirahatkan key
+        s = self.state[key]
+        if s["model"]: return s["model"]
+        if s["model_retry"] > time.time(): return MODEL_FALLBACK
+        found = MODEL_FALLBACK
+        try:
+            for m in genai.list_models(client=self.client(key, "model")):
+                if 'generateContent' in m.supported_generation_methods:
+                    if MODEL_PREFERENCE in m.name: found = m.name; break
+        except Exception as e:
+            record_metric("llm_error", key=s["label"], error=f"list_models: {str(e)[:300]}")
+            if is_quota_error(e): raise
+            s["model_retry"] = time.time() + MODEL_LOOKUP_RETRY_SEC
+            return found
+        s["model"] = found
+        return found
+
+class CachedResponse:
+    def __init__(self, text): self.text = text
+
+@st.cache_resource
+def get_key_scheduler(keys):
+    return KeyScheduler(keys)
+
+@st.cache_resource
+def get_generation_service():
+    return FairQueue(LLM_WORKERS, {"interaktif": LLM_USER_CONCURRENCY, "batch": LLM_BATCH_CONCURRENCY}, LLM_USER_QUEUE, "llm", "AI")
+
+def get_model(user=None, on_wait=None, lane="interaktif"):
+    """Model dengan rotasi key. Semua generate lewat antrian bersama atas nama `user` di jalur `lane`;
+    on_wait(posisi) dipanggil selama menunggu giliran (posisi None = sudah jalan)."""
+    sched = get_key_scheduler(tuple(k for k in API_KEYS_POOL if "MASUKKAN" not in k))
+    svc = get_generation_service()
+    user = user or current_user()
     class RotatingModel:
-        def generate_content(self, prompt):
-            errors = []
-            for key in API_KEYS_POOL:
-                if "MASUKKAN" in key: continue 
+        keys = list(sched.state)
+
+        def _call(self, prompt, stream=False, kind="umum"):
+            # Key yang berhasil dikembalikan dalam keadaan masih dipegang; pemanggil wajib release
+            errors = []; tried = set(); deadline = time.time() + KEY_WAIT_MAX_SEC
+            while True:
+                key = sched.acquire(exclude=tried)
+                if key is None:
+                    # Key sisa belum error, hanya tertahan jatah RPM/cooldown: tunggu yang paling cepat bebas
+                    wait_sec = sched.wait_time(exclude=tried)
+                    if wait_sec is None or time.time() + wait_sec > deadline: break
+                    time.sleep(wait_sec + 0.05); continue
+                tried.add(key)
+                t0 = time.perf_counter()
                 try:
-                    genai.configure(api_key=key)
-                    found = "gemini-pro"
-                    try:
-                        for m in genai.list_models():
-                            if 'generateContent' in m.supported_generation_methods:
-                                if 'flash' in m.name: found = m.name; break
-                    except: pass
-                    return genai.GenerativeModel(found, safety_settings=safe).generate_content(prompt)
+                    model = genai.GenerativeModel(sched.model_name(key), safety_settings=SAFETY_SETTINGS)
+                    model._client = sched.client(key)
+                    res = model.generate_content(prompt, stream=stream)
+                    return key, res, t0
                 except Exception as e:
-                    if "429" in str(e) or "quota" in str(e).lower(): continue 
-                    else: errors.append(str(e))
+                    sched.release(key, e)
+                    record_metric("llm_error", key=sched.state[key]["label"], prompt=kind, error=str(e)[:300],
+                                  ms=round((time.perf_counter() - t0) * 1000, 1))
+                    if not is_quota_error(e): errors.append(str(e))
             raise Exception(f"Semua API Key sibuk/limit. Detail: {errors}")
+
+        def _queued(self, fn, poll):
+            """Masukkan fn ke antrian; poll(fut) dipanggil tiap LLM_QUEUE_POLL_SEC sampai fn selesai."""
+            fut = svc.submit(user, fn, lane); shown = None
+            try:
+                while not wait([fut], timeout=LLM_QUEUE_POLL_SEC).done:
+                    if poll(fut) is False: break
+                    pos = svc.position(user, fut)
+                    if on_wait and pos != shown: on_wait(pos); shown = pos
+                return fut
+            finally:
+                svc.cancel(user, fut)
+                if on_wait and shown is not None: on_wait(None)
+
+        def _record(self, kind, key, t0, res, **extra):
+            usage = getattr(res, "usage_metadata", None)
+            record_metric("llm", prompt=kind, key=sched.state[key]["label"], ms=round((time.perf_counter() - t0) * 1000, 1),
+                          tokens_in=getattr(usage, "prompt_token_count", None), tokens_out=getattr(usage, "candidates_token_count", None), **extra)
+
+        def generate_content(self, prompt, cache=False, refresh=False, kind="umum", cancelled=None):
+            """cache=True untuk prompt deterministik: respon disimpan di disk, refresh=True memaksa generate ulang.
+            cancelled() True selagi masih antri: permintaan dibuang dari antrian (CancelledError)."""
+            if cache:
+                cache_key = json.dumps([prompt, MODEL_PREFERENCE, SAFETY_SETTINGS])
+                if not refresh:
+                    hit = cache_get("llm", cache_key, LLM_CACHE_TTL)
+                    if hit is not None:
+                        record_metric("llm_cache", prompt=kind, hit=True)
+                        return CachedResponse(hit)
+            def run():
+                key, res, t0 = self._call(prompt, kind=kind)
+                sched.release(key)
+                self._record(kind, key, t0, res)
+                return res
+            res = self._queued(run, lambda fut: False if cancelled and cancelled() else None).result()
+            if cache:
+                record_metric("llm_cache", prompt=kind, hit=False)
+                try: cache_put("llm", cache_key, res.text, LLM_CACHE_MAX_ENTRIES)
+                except ValueError: pass   # respon diblokir, tidak ada teks
+            return res
+
+        def stream_text(self, prompt, kind="umum", cancelled=None):
+            """Generator potongan teks. Stream dibaca worker antrian; key dilepas saat stream selesai,
+            gagal, atau dibatalkan (generator ditutup). cancelled() True selagi antri: tidak ada potongan sama sekali."""
+            pieces = queue.Queue(); stop = threading.Event()
+            def run():
+                key, res, t0 = self._call(prompt, stream=True, kind=kind)
+                err = None; first = None
+                try:
+                    for chunk in res:
+                        if stop.is_set(): break
+                        try: piece = chunk.text
+                        except ValueError: piece = ""   # chunk tanpa teks (mis. hanya metadata)
+                        if piece:
+                            if first is None: first = round((time.perf_counter() - t0) * 1000, 1)
+                            pieces.put(piece)
+                except Exception as e: err = e; raise
+                finally:
+                    sched.release(key, err)
+                    self._record(kind, key, t0, res, stream=True, first_token_ms=first, done=err is None and not stop.is_set())
+                    pieces.put(None)
+            fut = None
+            try:
+                # Menunggu giliran sampai potongan pertama tiba (atau job gagal sebelum stream mulai)
+                fut = self._queued(run, lambda fut: False if not pieces.empty() or (cancelled and cancelled()) else None)
+                if fut.cancelled(): return      # dibuang dari antrian sebelum dapat giliran
+                while True:
+                    try: piece = pieces.get(timeout=LLM_QUEUE_POLL_SEC)
+                    except queue.Empty:
+                        if fut.done() and pieces.empty(): break
+                        continue
+                    if piece is None: break
+                    yield piece
+                fut.result()
+            finally: stop.set()
     return RotatingModel()
 
+def generate_batch(prompts, progress=None, cache=False, kind="batch", user=None, cancelled=None, on_result=None):
+    """Generate banyak prompt paralel lintas key (jatah per key tetap diatur KeyScheduler) di jalur batch
+    antrian generate, sampai LLM_BATCH_CONCURRENCY bersamaan per user tanpa memakan jatah interaktif.
+    Hasil urut sesuai input; yang gagal setelah retry bernilai None dan pesannya ada di `errors`.
+    Begitu cancelled() True, prompt yang belum mulai dilewati (None, bukan error); on_result(i, teks) per hasil."""
+    model = get_model(user=user, lane="batch")
+    def one(p):
+        for attempt in range(BATCH_RETRIES + 1):
+            if cancelled and cancelled(): return None
+            try: return model.generate_content(p, cache=cache, kind=kind, cancelled=cancelled).text
+            except CancelledError: return None
+            except Exception:
+                if attempt == BATCH_RETRIES: raise
+                time.sleep(BATCH_RETRY_SEC * (attempt + 1))
+    results = [None] * len(prompts); errors = {}
+    if not prompts: return results, errors
+    with ThreadPoolExecutor(max_workers=max(1, min(len(prompts), len(model.keys), LLM_BATCH_CONCURRENCY))) as ex:
+        futs = {ex.submit(one, p): i for i, p in enumerate(prompts)}
+        for done, fut in enumerate(as_completed(futs), 1):
+            try: results[futs[fut]] = fut.result()
+            except Exception as e: errors[futs[fut]] = str(e)
+            if on_result and results[futs[fut]] is not None: on_result(futs[fut], results[futs[fut]])
+            if progress: progress(done, len(prompts))
+    return results, errors
+
 def clean_parse_list(text_response):
     try:
         match = re.search(r'\[.*\]', text_response, re.DOTALL)
@@ -160,11 +890,134 @@ def clean_parse_list(text_response):
         return [l.strip().replace('- ','').replace('* ','') for l in text_response.split('\n') if l.strip()]
     except: return []
 
+def split_sections(text):
+    """[(judul, isi)] per sub-bab `## ` yang ditambahkan render_bab; teks sebelum sub-bab pertama berjudul ""."""
+    parts = re.split(r'(?m)^## (.+)\n', text)
+    out = [("", parts[0])] if parts[0].strip() else []
+    return out + [(parts[i].strip(), parts[i + 1]) for i in range(1, len(parts) - 1, 2)]
+
+def clip_words(text, n):
+    words = text.split()
+    return " ".join(words[:n]) + (" ..." if len(words) > n else "")
+
+def summarize_chapter(text, label, user=None):
+    """Ringkasan map-reduce satu bab: tiap sub-bab diringkas, lalu ringkasannya digabung.
+    Semua prompt ringkasan lewat cache LLM (kunci = isi), jadi hanya sub-bab yang berubah yang di-generate ulang."""
+    sections = [(t, b.strip()) for t, b in split_sections(text) if b.strip()]
+    if not sections: return ""
+    todo = [b for _, b in sections if len(b.split()) > SUMMARY_SECTION_WORDS]
+    done, _ = generate_batch([f"Ringkas sub-bab tesis berikut maksimal {SUMMARY_SECTION_WORDS} kata. Pertahankan variabel, "
+                              f"angka, temuan, dan sitasi kunci (Nama, Tahun). TANPA BASA BASI.\n\n{b}" for b in todo],
+                             cache=True, kind="ringkasan", user=user)
+    done = dict(zip(todo, done))
+    lines = [f"- {t or label}: {' '.join((done.get(b) or clip_words(b, SUMMARY_SECTION_WORDS)).split())}" for t, b in sections]
+    joined = "\n".join(lines)
+    if len(joined.split()) <= SUMMARY_CHAPTER_WORDS: return joined
+    p = (f"Gabungkan ringkasan sub-bab {label} berikut menjadi satu ringkasan padu maksimal {SUMMARY_CHAPTER_WORDS} kata. "
+         f"Pertahankan variabel, angka, dan temuan kunci. TANPA BASA BASI.\n\n{joined}")
+    try: return get_model(user=user, lane="batch").generate_content(p, cache=True, kind="ringkasan").text.strip()
+    except Exception as e:
+        record_metric("llm_error", prompt="ringkasan", error=str(e)[:300])
+        return clip_words(joined, SUMMARY_CHAPTER_WORDS)
+
+def build_subbab_prompt(sub, ctx, extra, spec):
+    return f"""
+            Peran: Penulis Tesis Akademik ({spec['bidang']}).
+            Topik Sub-Bab: '{sub}'. Judul: {spec['judul']}.
+            
+            DATA PENDUKUNG (CONTEXT):
+            {ctx}
+            {extra}
+            
+            INSTRUKSI KHUSUS (WAJIB DIPATUHI):
+            1. FILTER TAHUN CERDAS: Jika ada data di 'Context' yang tahunnya < 2015, JANGAN jadikan argumen utama.
+            2. SITASI CERDAS: Gunakan format APA (Nama, Tahun). DILARANG KERAS menggunakan angka [1].
+            3. GAYA BAHASA HUMANIS: Tulis dengan gaya natural manusia, variasi kalimat, hindari kata robotik.
+            4. NO PROLOG.
+            5. Panjang: 600-900 kata.
+            """
+
+def chapter_digest(chapters, user):
+    """Ringkasan bab-bab sebelumnya (map-reduce, di-cache per isi) sebagai konteks prompt."""
+    parts = []
+    for i, text in enumerate(chapters, 1):
+        summary = summarize_chapter(text, f"BAB {i}", user)
+        if summary: parts.append(f"BAB {i}:\n{summary}")
+    if not parts: return ""
+    return "RINGKASAN BAB SEBELUMNYA (jaga konsistensi istilah, variabel & temuan):\n" + "\n\n".join(parts)
+
+def build_subbab_prompts(job, user, subs, spec, kind):
+    """Prompt disusun di job, bukan di sesi: ringkasan bab sebelumnya bisa butuh beberapa generate (cache miss)
+    dan ikut antre di jalur batch, jadi halaman tidak tertahan dan refresh tidak membuang hasilnya."""
+    if any(spec["chapters"]): job.progress(message="Meringkas bab sebelumnya...")
+    ext = "\n\n".join(x for x in (spec["extra"], chapter_digest(spec["chapters"], user)) if x)
+    job.progress(message="")
+    budget = context_budget(kind, ext)
+    return [build_subbab_prompt(x, retrieve_relevant_context(x, spec["index"], budget), ext, spec) for x in subs]
+
+def job_write_subbab(job, user, key_naskah, sub, spec, stream):
+    """Job Tulis satu sub-bab. Mode stream: teks parsial tampil di editor bab dan tersimpan berkala;
+    Batal, gagal, atau server mati tetap menyimpan yang sudah tertulis."""
+    prompt = build_subbab_prompts(job, user, [sub], spec, "subbab")[0]
+    if job.cancelled(): return None
+    model = get_model(user=user, on_wait=lambda pos: job.progress(message="" if pos is None else f"Antrian AI: posisi {pos + 1}"))
+    if not stream:
+        try: text = model.generate_content(prompt, kind="subbab", cancelled=job.cancelled).text
+        except CancelledError: return None      # dibatalkan selagi antri
+        return {"key": key_naskah, "sub": sub, "text": text, "done": not job.cancelled()}
+    parts = []; gen = model.stream_text(prompt, kind="subbab", cancelled=job.cancelled)
+    try:
+        for piece in gen:
+            parts.append(piece); job.partial({"key": key_naskah, "sub": sub, "text": "".join(parts), "done": False})
+            job.progress(message=f"{sum(len(p) for p in parts)} karakter")
+            if job.cancelled(): break
+    finally: gen.close()
+    return {"key": key_naskah, "sub": sub, "text": "".join(parts), "done": not job.cancelled()} if parts else None
+
+def job_write_all(job, user, key_naskah, subs, spec):
+    prompts = build_subbab_prompts(job, user, subs, spec, "batch")
+    if job.cancelled(): return None
+    # Sub-bab yang sudah jadi ikut tersimpan sebagai hasil parsial; Batal berhenti memulai prompt baru
+    texts = [None] * len(subs)
+    def keep(i, text): texts[i] = text; job.partial({"key": key_naskah, "subs": subs, "texts": texts, "errors": []})
+    results, errors = generate_batch(prompts, progress=lambda d, t: job.progress(d, t, f"{d}/{t} sub-bab selesai"), user=user,
+                                     cancelled=job.cancelled, on_result=keep)
+    return {"key": key_naskah, "subs": subs, "texts": results, "errors": [subs[i] for i in sorted(errors)]}
+
 # ==========================================
 # 5. SMART SEARCH
 # ==========================================
-def search_pubmed(keyword, limit=10, max_age_years=10, is_fulltext=False):
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+@st.cache_resource
+def get_http_session():
+    # Koneksi keep-alive dipakai bersama semua sesi
+    s = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    s.mount("https://", adapter); s.mount("http://", adapter)
+    return s
+
+@st.cache_resource
+def get_search_pool():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="search")
+
+def parse_pubmed_docsum(doc, year_now, min_year):
+    items = {}; authors = []
+    for it in doc.iter('Item'):
+        name = it.get('Name')
+        if name == 'Author': authors.append(it.text or "")
+        elif name not in items: items[name] = it.text
+    pmid = doc.findtext('Id'); title = items.get('Title')
+    if not pmid or not title: return None
+    m = re.match(r'\d{4}', items.get('PubDate') or "")
+    year = int(m.group(0)) if m else year_now
+    if year > year_now or year < min_year: return None
+    auth = authors[0].split()[0] + " et al." if authors and authors[0].strip() else "Team"
+    doi = items.get('DOI') or items.get('doi') or "-"
+    link = f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/"
+    return {"Source": "PubMed", "Judul": title, "Penulis": auth, "Tahun": year, "DOI": doi, "Link": link}
+
+def search_pubmed(keyword, limit=10, max_age_years=10, is_fulltext=False, on_page=None):
+    base_url = PUBMED_BASE_URL
+    http = get_http_session()
     year_now = datetime.date.today().year
     min_year = year_now - max_age_years
     
@@ -172,100 +1025,268 @@ def search_pubmed(keyword, limit=10, max_age_years=10, is_fulltext=False):
     if is_fulltext: term += " AND free full text[sb]"
         
     try:
-        search_url = f"{base_url}/esearch.fcgi?db=pubmed&term={term}&retmax={limit*2}&retmode=json"
-        res = requests.get(search_url, timeout=10).json()
-        id_list = res.get('esearchresult', {}).get('idlist', [])
-        
-        if not id_list: return []
+        # ID disimpan di history server NCBI (WebEnv), lalu metadata ringan diambil per batch via esummary
+        params = {"db": "pubmed", "term": term, "retmax": 0, "usehistory": "y", "retmode": "json"}
+        res = http.get(f"{base_url}/esearch.fcgi", params=params, timeout=10).json().get('esearchresult', {})
+        count = int(res.get('count', 0))
+        if not count or 'webenv' not in res: return []
         
-        ids = ','.join(id_list)
-        fetch_url = f"{base_url}/efetch.fcgi?db=pubmed&id={ids}&retmode=xml"
-        root = ET.fromstring(requests.get(fetch_url, timeout=15).content)
-        
-        results = []
-        for article in root.findall(".//PubmedArticle"):
-            try:
-                title = article.find(".//ArticleTitle").text
-                try: year = int(article.find(".//PubDate/Year").text)
-                except: year = year_now
-                
-                if year > year_now or year < min_year: continue
-
-                try: auth = article.find(".//AuthorList/Author/LastName").text + " et al."
-                except: auth = "Team"
-                
-                pmid = article.find(".//PMID").text
-                doi = "-"
-                for i in article.findall(".//ArticleIdList/ArticleId"):
-                    if i.get('IdType') == 'doi': doi = i.text
-                
-                link = f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/"
-                results.append({"Source": "PubMed", "Judul": title, "Penulis": auth, "Tahun": year, "DOI": doi, "Link": link})
-                if len(results) >= limit: break
-            except: continue
+        results = []; step = min(PUBMED_BATCH, limit)
+        for start in range(0, min(count, limit * 3), step):
+            params = {"db": "pubmed", "query_key": res['querykey'], "WebEnv": res['webenv'], "retstart": start, "retmax": step}
+            n0 = len(results)
+            with http.get(f"{base_url}/esummary.fcgi", params=params, timeout=15, stream=True) as r:
+                r.raise_for_status()
+                r.raw.decode_content = True
+                for _, el in ET.iterparse(r.raw):
+                    if el.tag != 'DocSum': continue
+                    rec = parse_pubmed_docsum(el, year_now, min_year)
+                    el.clear()
+                    if rec: results.append(rec)
+                    if len(results) >= limit: break
+            if on_page and len(results) > n0: on_page(results[n0:])
+            if len(results) >= limit: break
         return results
-    except: return []
+    except requests.RequestException: raise
+    except Exception as e:
+        record_metric("search_error", source="PubMed", error=str(e)[:300]); return []
+
+def parse_crossref_items(data, year_now, min_year, is_oa=False, is_fulltext=False):
+    final_results = []
+    for i in data:
+        y = 0
+        if 'published-print' in i: y = i['published-print']['date-parts'][0][0]
+        elif 'published-online' in i: y = i['published-online']['date-parts'][0][0]
+        elif 'created' in i: y = i['created']['date-parts'][0][0]
+        if y > year_now or y < min_year: continue
+
+        l = i.get('URL', '-')
+        pdf_link = ""
+        has_pdf = False
+        if 'link' in i:
+            for lnk in i['link']:
+                if 'pdf' in lnk.get('content-type', '').lower():
+                    pdf_link = lnk.get('URL'); has_pdf = True; break
+        if not pdf_link: pdf_link = l 
+
+        has_license = 'license' in i
+        if is_fulltext and not has_pdf: continue
+        if is_oa and not has_license: continue
+
+        t = i.get('title', ['No Title'])[0]
+        d = i.get('DOI', '-')
+        try: a = i['author'][0]['family'] + " et al."
+        except: a = "Unknown"
 
-def search_crossref(keyword, limit=10, max_age_years=10, is_oa=False, is_fulltext=False):
-    url = "https://api.crossref.org/works"
+        final_results.append({"Source": "Crossref", "Judul": t, "Penulis": a, "Tahun": y, "DOI": d, "Link": pdf_link})
+    return final_results
+
+def search_crossref(keyword, limit=10, max_age_years=10, is_oa=False, is_fulltext=False, on_page=None, deadline=None):
+    """Panen hasil Crossref sampai `limit` terkumpul. Halaman pertama langsung seukuran `limit` (satu request
+    untuk kasus umum); cursor hanya dipakai kalau filter lokal membuang sebagian hasil.
+    Filter tahun/fulltext/lisensi dikerjakan server; pengecekan lokal hanya penegasan (mis. link harus PDF)."""
+    url = CROSSREF_URL
     year_now = datetime.date.today().year
     min_year = year_now - max_age_years
     
     clean_kw = re.sub(r'[^\x00-\x7F]+', '', keyword)
     
+    filters = f"type:journal-article,from-pub-date:{min_year}-01-01,until-pub-date:{year_now}-12-31"
+    if is_fulltext: filters += ",has-full-text:true"
+    if is_oa: filters += ",has-license:true"
     params = {
         "query": clean_kw, 
-        "rows": limit * 5,
+        "rows": min(max(limit, CROSSREF_PAGE_ROWS), 1000), "cursor": "*",
         "select": "title,DOI,URL,author,published-print,published-online,created,link,license",
-        "filter": f"type:journal-article,from-pub-date:{min_year}-01-01",
+        "filter": filters,
         "sort": "published", "order": "desc"
     }
     
+    http = get_http_session(); final_results = []
     try:
-        data = requests.get(url, params=params, timeout=20).json()['message']['items']
-        final_results = []
-        for i in data:
-            y = 0
-            if 'published-print' in i: y = i['published-print']['date-parts'][0][0]
-            elif 'published-online' in i: y = i['published-online']['date-parts'][0][0]
-            elif 'created' in i: y = i['created']['date-parts'][0][0]
-            if y > year_now or y < min_year: continue
-
-            l = i.get('URL', '-')
-            pdf_link = ""
-            has_pdf = False
-            if 'link' in i:
-                for lnk in i['link']:
-                    if 'pdf' in lnk.get('content-type', '').lower():
-                        pdf_link = lnk.get('URL'); has_pdf = True; break
-            if not pdf_link: pdf_link = l 
-
-            has_license = 'license' in i
-            if is_fulltext and not has_pdf: continue
-            if is_oa and not has_license: continue
-
-            t = i.get('title', ['No Title'])[0]
-            d = i.get('DOI', '-')
-            try: a = i['author'][0]['family'] + " et al."
-            except: a = "Unknown"
-
-            final_results.append({"Source": "Crossref", "Judul": t, "Penulis": a, "Tahun": y, "DOI": d, "Link": pdf_link})
-            if len(final_results) >= limit: break
+        for _ in range(CROSSREF_MAX_PAGES):
+            timeout = 20 if deadline is None else min(20, deadline - time.time())
+            if timeout <= 0: break
+            msg = http.get(url, params=params, timeout=timeout).json()['message']
+            page = parse_crossref_items(msg['items'], year_now, min_year, is_oa, is_fulltext)[:limit - len(final_results)]
+            final_results += page
+            if on_page and page: on_page(page)
+            if len(final_results) >= limit or len(msg['items']) < params["rows"] or not msg.get('next-cursor'): break
+            params["cursor"] = msg['next-cursor']
         return final_results
-    except: return []
+    except requests.RequestException:
+        if final_results: return final_results   # halaman berikutnya gagal: pakai yang sudah terkumpul
+        raise
+    except Exception as e:
+        record_metric("search_error", source="Crossref", error=str(e)[:300]); return final_results
+
+def title_fingerprint(title):
+    """Sidik judul: huruf kecil tanpa aksen & tanda baca, jadi beda kapital/tanda baca antar sumber tetap sama."""
+    norm = unicodedata.normalize("NFKD", title or "").encode("ascii", "ignore").decode().lower()
+    return hashlib.sha1("".join(re.findall(r'[a-z0-9]+', norm)).encode()).hexdigest()[:16]
+
+def ref_keys(r):
+    """Kunci dedup satu hasil pencarian: DOI, PMID (dari link PubMed), lalu sidik judul.
+    Judul placeholder ("No Title") atau terlalu pendek tidak diberi sidik."""
+    doi = (r.get('DOI') or "").strip().lower()
+    doi = re.sub(r'^https?://(dx\.)?doi\.org/', '', doi)
+    m = re.search(r'pubmed\.ncbi\.nlm\.nih\.gov/(\d+)', r.get('Link') or "")
+    title = r.get('Judul') or ""
+    keys = []
+    if doi and doi != "-": keys.append(f"doi:{doi}")
+    if m: keys.append(f"pmid:{m.group(1)}")
+    if title.strip(" .").lower() not in PLACEHOLDER_TITLES and len(re.findall(r'\w+', title)) >= TITLE_FP_MIN_WORDS:
+        keys.append(f"fp:{title_fingerprint(title)}")
+    return keys
+
+def ref_conflict(a, b):
+    """True kalau dua kumpulan kunci sama-sama punya DOI (atau PMID) tapi berbeda: pasti paper lain."""
+    for p in ("doi:", "pmid:"):
+        x = {k for k in a if k.startswith(p)}; y = {k for k in b if k.startswith(p)}
+        if x and y and not x & y: return True
+    return False
+
+def ref_match(keys, owner, known):
+    """Pemilik (index/id) record lama yang sama dengan `keys`: DOI/PMID sama, atau sidik judul sama
+    selama DOI/PMID keduanya tidak bertentangan. owner: kunci -> pemilik, known: pemilik -> kunci."""
+    for k in keys:
+        o = owner.get(k)
+        if o is not None and (not k.startswith("fp:") or not ref_conflict(keys, known[o])): return o
+    return None
 
-def smart_search_dispatcher(bidang, kw, lim, age, oa, ft):
-    results = []
-    if "Kesehatan" in bidang or "Kedokteran" in bidang:
-        results += search_pubmed(kw, lim, age, ft)
-    results += search_crossref(kw, lim, age, oa, ft)
-    seen = set(); unique = []
+def dedup_results(results, lim):
+    owner = {}; known = []; unique = []
     for r in results:
-        if r['Judul'] not in seen:
-            unique.append(r); seen.add(r['Judul'])
+        keys = ref_keys(r)
+        if ref_match(keys, owner, known) is not None: continue
+        for k in keys: owner.setdefault(k, len(unique))
+        unique.append(r); known.append(set(keys))
     return unique[:lim]
 
-def generate_search_formulas(title, bidang):
+def smart_search_dispatcher(bidang, kw, lim, age, oa, ft, on_results=None):
+    """on_results(hasil_sementara) dipanggil di thread pemanggil setiap ada halaman baru dari salah satu sumber."""
+    use_pubmed = "Kesehatan" in bidang or "Kedokteran" in bidang
+    # Operator Boolean PubMed hanya berlaku dalam huruf besar, jadi AND/OR/NOT tidak ikut dikecilkan
+    norm_kw = re.sub(r'\w+', lambda m: m.group(0) if m.group(0) in ("AND", "OR", "NOT") else m.group(0).lower(), " ".join(kw.split()))
+    cache_key = json.dumps([norm_kw, lim, age, oa, ft, use_pubmed])
+    cached = cache_get("search", cache_key, SEARCH_CACHE_TTL)
+    record_metric("search_cache", hit=cached is not None)
+    if cached is not None: return cached
+
+    # Semua sumber jalan bersamaan; sumber yang lambat/gagal tidak menahan yang lain.
+    # Halaman yang masuk diteruskan ke on_results; sumber yang lewat batas waktu tetap menyumbang halaman yang sudah tiba.
+    pool = get_search_pool(); t0 = time.time(); pages = queue.Queue()
+
+    def run_source(name, fn, *args):
+        try:
+            with timed("search", source=name) as m:
+                res = fn(*args); m["hits"] = len(res)
+                return res
+        finally: pages.put((name, None))   # tanda sumber selesai
+
+    jobs = {}
+    if use_pubmed: jobs["PubMed"] = pool.submit(run_source, "PubMed", search_pubmed, kw, lim, age, ft, lambda rows: pages.put(("PubMed", rows)))
+    jobs["Crossref"] = pool.submit(run_source, "Crossref", search_crossref, kw, lim, age, oa, ft,
+                                   lambda rows: pages.put(("Crossref", rows)), t0 + SEARCH_TIMEOUT["Crossref"])
+    partial = {name: [] for name in jobs}; final = {}; finished = set(); complete = True
+    while len(final) < len(jobs):
+        wait_sec = min(t0 + SEARCH_TIMEOUT[n] for n in jobs if n not in final) - time.time()
+        try:
+            name, rows = pages.get(timeout=max(0.01, wait_sec))
+            if rows is None: finished.add(name)
+            elif name not in final:
+                partial[name] += rows
+                if on_results: on_results(dedup_results([r for n in jobs for r in final.get(n, partial[n])], lim))
+        except queue.Empty: pass
+        for name, job in jobs.items():
+            if name in final: continue
+            if name in finished or job.done():
+                try: final[name] = job.result(timeout=5); continue
+                except Exception as e: err = str(e)[:300] or type(e).__name__
+            elif time.time() > t0 + SEARCH_TIMEOUT[name]: err = "TimeoutError"
+            else: continue
+            complete = False; final[name] = partial[name]
+            record_metric("search_error", source=name, error=err)
+
+    unique = dedup_results([r for name in jobs for r in final[name]], lim)
+    if complete: cache_put("search", cache_key, unique)
+    return unique
+
+class ReferenceLibrary:
+    """Pustaka referensi lokal: semua hasil pencarian disimpan sekali (dedup DOI/PMID/sidik judul lewat
+    peta kunci di memori), ditautkan ke user yang menemukannya, dan bisa dicari offline (FTS5, fallback LIKE)."""
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS refs (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT, title TEXT, authors TEXT,
+                                             year INTEGER, doi TEXT, link TEXT, keys TEXT, added REAL);
+            CREATE TABLE IF NOT EXISTS user_refs (user TEXT, ref_id INTEGER, query TEXT, added REAL, PRIMARY KEY (user, ref_id));
+        """)
+        try:
+            with self.conn:
+                self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS refs_fts USING fts5(title, authors)")
+                self.conn.execute("INSERT INTO refs_fts (rowid, title, authors) SELECT id, title, authors FROM refs WHERE id NOT IN (SELECT rowid FROM refs_fts)")
+            self.fts = True
+        except sqlite3.OperationalError: self.fts = False   # SQLite tanpa FTS5
+        self.ids = {}   # "doi:..." / "pmid:..." / "fp:..." -> refs.id
+        self.keys = {}  # refs.id -> kunci miliknya (cek DOI/PMID bertentangan)
+        for rid, keys in self.conn.execute("SELECT id, keys FROM refs"):
+            self.keys[rid] = set(json.loads(keys))
+            for k in self.keys[rid]: self.ids.setdefault(k, rid)
+
+    def add(self, user, results, query=""):
+        """Simpan hasil pencarian; duplikat (lihat ref_match) hanya melengkapi DOI & kunci baru."""
+        now = time.time()
+        with self.lock, self.conn:
+            for r in results:
+                keys = ref_keys(r)
+                rid = ref_match(keys, self.ids, self.keys)
+                if rid is None:
+                    rid = self.conn.execute("INSERT INTO refs (source, title, authors, year, doi, link, keys, added) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                            (r.get('Source'), r.get('Judul'), r.get('Penulis'), r.get('Tahun'), r.get('DOI'), r.get('Link'), json.dumps(keys), now)).lastrowid
+                    if self.fts: self.conn.execute("INSERT INTO refs_fts (rowid, title, authors) VALUES (?, ?, ?)", (rid, r.get('Judul'), r.get('Penulis')))
+                    self.keys[rid] = set(keys)
+                elif not self.keys[rid].issuperset(keys):
+                    self.keys[rid].update(keys)
+                    self.conn.execute("UPDATE refs SET keys=?, doi=CASE WHEN doi IS NULL OR doi='-' THEN ? ELSE doi END WHERE id=?",
+                                      (json.dumps(sorted(self.keys[rid])), r.get('DOI'), rid))
+                for k in keys: self.ids.setdefault(k, rid)
+                self.conn.execute("INSERT OR IGNORE INTO user_refs VALUES (?, ?, ?, ?)", (user, rid, query, now))
+
+    def search(self, query, user=None, limit=LIBRARY_SEARCH_LIMIT):
+        """Cari judul/penulis; user=None berarti pustaka bersama semua user. Query kosong = terbaru dulu."""
+        terms = re.findall(r'\w+', query or "")
+        sql = "SELECT r.source, r.title, r.authors, r.year, r.doi, r.link FROM refs r"
+        args = []
+        if user is not None: sql += " JOIN user_refs u ON u.ref_id = r.id AND u.user = ?"; args.append(user)
+        if terms and self.fts:
+            sql += " JOIN refs_fts f ON f.rowid = r.id WHERE refs_fts MATCH ? ORDER BY bm25(refs_fts)"
+            args.append(" ".join(f'"{t}"*' for t in terms))
+        elif terms:
+            sql += " WHERE " + " AND ".join("(r.title LIKE ? OR r.authors LIKE ?)" for _ in terms) + " ORDER BY r.id DESC"
+            for t in terms: args += [f"%{t}%", f"%{t}%"]
+        else: sql += " ORDER BY r.id DESC"
+        with self.lock: rows = self.conn.execute(sql + " LIMIT ?", args + [limit]).fetchall()
+        return [dict(zip(["Source", "Judul", "Penulis", "Tahun", "DOI", "Link"], row)) for row in rows]
+
+    def count(self, user=None):
+        with self.lock:
+            if user is None: return self.conn.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+            return self.conn.execute("SELECT COUNT(*) FROM user_refs WHERE user=?", (user,)).fetchone()[0]
+
+@st.cache_resource
+def get_reference_library():
+    return ReferenceLibrary(DB_FILE)
+
+def job_search(job, user, bidang, kw, lim, age, oa, ft):
+    def page(rows): job.partial(rows); job.progress(len(rows), lim, f"{len(rows)} hasil sementara")
+    results = smart_search_dispatcher(bidang, kw, lim, age, oa, ft, on_results=page)
+    get_reference_library().add(user, results, kw)
+    return None if job.cancelled() else results
+
+def generate_search_formulas(title, bidang, refresh=False, on_wait=None):
     if not title: return []
     p = f"""
     Bertindaklah sebagai Pustakawan Riset Senior.
@@ -281,85 +1302,433 @@ def generate_search_formulas(title, bidang):
     3. Rumus ADVANCED BOOLEAN: Gunakan tanda kurung, OR untuk sinonim, dan AND antar variabel.
        Contoh Format: ("Var1" OR "Sinonim1") AND ("Var2" OR "Sinonim2") AND ("Var3")
     """
-    try: return clean_parse_list(get_model().generate_content(p).text)
-    except: return []
+    try: return clean_parse_list(get_model(on_wait=on_wait).generate_content(p, cache=True, refresh=refresh, kind="rumus").text)
+    except Exception as e:
+        record_metric("llm_error", prompt="rumus", error=str(e)[:300]); return []
+
+@st.cache_resource
+def get_pdf_executor():
+    # Fungsi worker ada di pdf_worker.py (bisa di-pickle walau __main__ berganti tiap rerun). Pool dibuat sekali per proses dan worker-nya
+    # langsung di-fork di sini (dipanggil dari thread skrip, lihat bagian 8), bukan dari thread job.
+    try:
+        ex = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("fork"))
+        ex.submit(int).result()
+        return ex
+    except (ValueError, BrokenExecutor): return ThreadPoolExecutor(max_workers=PDF_WORKERS)
+
+def run_pdf_tasks(tasks, progress=None):
+    """{i: {start: [teks halaman]}} dari task (i, path, start, end). Paling banyak PDF_INFLIGHT task ada di pool
+    bersama sekaligus, jadi satu PDF besar tidak menutup antrian user lain."""
+    ex = get_pdf_executor(); queued = deque(tasks); pending = {}; out = {}; done = 0
+    while queued or pending:
+        while queued and len(pending) < PDF_INFLIGHT:
+            task = queued.popleft()
+            try: fut = ex.submit(extract_pdf_pages, *task[1:])
+            except BrokenExecutor as e: fut = Future(); fut.set_exception(e)
+            pending[fut] = task
+        for fut in wait(pending, return_when=FIRST_COMPLETED).done:
+            i, path, s, e = pending.pop(fut)
+            try: pages = fut.result()
+            except Exception as err:
+                if isinstance(err, BrokenExecutor): get_pdf_executor.clear()   # dibuat ulang di run skrip berikutnya
+                record_metric("pdf_error", error=f"{type(err).__name__}: {str(err)[:300]}", fallback="inline")
+                pages = extract_pdf_pages(path, s, e)   # pool rusak / tidak bisa fork
+            out.setdefault(i, {})[s] = pages; done += 1
+            if progress: progress(done, len(tasks))
+    return out
+
+def pdf_cache_path(digest, max_pages):
+    return os.path.join(CACHE_DIR, "pdf", f"{digest}_{max_pages}.txt")
+
+def extract_pdf_documents(files, max_pages=PDF_MAX_PAGES, progress=None):
+    """[(sha256, nama_file, teks)] per file unik. Hasil di-cache per hash isi file."""
+    t0 = time.perf_counter(); docs = []; todo = []; seen = set(); tmp = []
+    try:
+        for f in files:
+            data = f.getvalue()
+            digest = hashlib.sha256(data).hexdigest()
+            if digest in seen: continue
+            seen.add(digest)
+            try:
+                with open(pdf_cache_path(digest, max_pages), "r", encoding="utf-8") as fc: docs.append([digest, f.name, fc.read()])
+                continue
+            except OSError: pass
+            # Ditulis sekali ke file sementara; worker & hitung halaman membaca dari disk sesuai kebutuhan
+            fd, path = tempfile.mkstemp(suffix=".pdf"); tmp.append(path)
+            try:
+                with os.fdopen(fd, "wb") as fh: fh.write(data)
+                with open(path, "rb") as fh: n = min(len(PyPDF2.PdfReader(fh).pages), max_pages)
+            except Exception as e:
+                record_metric("pdf_error", file=f.name, error=str(e)[:300]); continue
+            docs.append([digest, f.name, None])
+            todo += [(len(docs) - 1, path, s, min(s + PDF_PAGES_PER_TASK, n)) for s in range(0, n, PDF_PAGES_PER_TASK)]
+        parts = run_pdf_tasks(todo, progress) if todo else {}
+    finally:
+        for path in tmp:
+            try: os.remove(path)
+            except OSError: pass
 
-def extract_text_from_pdfs(files):
-    text = ""
-    for f in files:
+    for i, ranges in parts.items():
+        docs[i][2] = "".join(p for s in sorted(ranges) for p in ranges[s])
+        path = pdf_cache_path(docs[i][0], max_pages)
         try:
-            reader = PyPDF2.PdfReader(f)
-            for p in range(min(len(reader.pages), 50)):
-                text += reader.pages[p].extract_text() + "\n"
-            text += f"\n--- SUMBER: {f.name} ---\n"
-        except: pass
-    return text
-
-def retrieve_relevant_context(query, text, top_k=3):
-    if not text: return ""
-    chunks = [text[i:i+4000] for i in range(0, len(text), 4000)]
-    scored = []
-    keywords = [k.lower() for k in query.split() if len(k)>4]
-    for c in chunks:
-        score = sum(c.lower().count(k) for k in keywords)
-        scored.append((score, c))
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return "\n...".join([s[1] for s in scored[:top_k]])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as fc: fc.write(docs[i][2])
+        except Exception as e: record_metric("cache_error", namespace="pdf", error=str(e)[:300])
+    pages = sum(e - s for _, _, s, e in todo); sec = time.perf_counter() - t0
+    record_metric("pdf", files=len(seen), cached=len(docs) - len({i for i, *_ in todo}), pages=pages,
+                  ms=round(sec * 1000, 1), pages_per_sec=round(pages / sec, 1) if pages and sec else None)
+    return [tuple(d) for d in docs if d[2] is not None]
+
+def format_pdf_doc(name, text):
+    return f"{text}\n--- SUMBER: {name} ---\n"
+
+def extract_text_from_pdfs(files, max_pages=PDF_MAX_PAGES, progress=None):
+    return "".join(format_pdf_doc(name, text) for _, name, text in extract_pdf_documents(files, max_pages, progress))
+
+class PdfBlob:
+    """Salinan file upload (nama + isi) yang aman dibawa ke thread job setelah rerun."""
+    def __init__(self, name, data): self.name = name; self.data = data
+    def getvalue(self): return self.data
+
+def job_process_pdfs(job, files, max_pages):
+    docs = extract_pdf_documents(files, max_pages, progress=lambda d, t: job.progress(d, t, f"Bagian {d}/{t}"))
+    if job.cancelled(): return None     # hasil ekstraksi tetap tersimpan di cache PDF
+    store = get_corpus_store()
+    return [[store.put(text), name] for _, name, text in docs]
+
+SOURCE_MARK = re.compile(r'\n--- SUMBER: (.+?) ---\n')
+
+def tokenize(text):
+    return re.findall(r'\w{3,}', text.lower())
+
+def split_sources(text, base=0):
+    """[(nama_file, start, end)] per file dari teks hasil extract_text_from_pdfs."""
+    out = []; pos = 0
+    for m in SOURCE_MARK.finditer(text):
+        out.append((m.group(1), base + pos, base + m.start())); pos = m.end()
+    if text[pos:].strip(): out.append(("-", base + pos, base + len(text)))
+    return out
+
+def chunk_spans(text, start, end):
+    """Potong text[start:end] di batas paragraf/kalimat, ~CHUNK_CHARS per potongan dengan overlap."""
+    seg = text[start:end]; n = len(seg)
+    cuts = [m.end() for m in re.finditer(r'[.!?]["\')\]]?\s+|\n\s*\n', seg)]
+    spans = []; s = 0
+    while s < n:
+        if n - s <= CHUNK_CHARS: e = n
+        else:
+            i = bisect.bisect_right(cuts, s + CHUNK_CHARS) - 1
+            e = cuts[i] if i >= 0 and cuts[i] > s + CHUNK_CHARS // 2 else s + CHUNK_CHARS
+        if seg[s:e].strip(): spans.append((start + s, start + e))
+        if e >= n: break
+        j = bisect.bisect_left(cuts, e - CHUNK_OVERLAP)
+        s = cuts[j] if j < len(cuts) and cuts[j] < e else e
+    return spans
+
+class DocIndex:
+    """Postings BM25 per dokumen, dibangun sekali per doc_id (hash isi) dan dipakai bersama semua sesi.
+    Append-only: satu file per dokumen di CORPUS_DIR/postings, tidak pernah ditulis ulang."""
+    def __init__(self, root):
+        self.root = os.path.join(root, "postings"); self.lock = threading.Lock(); self.docs = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def get(self, doc_id):
+        """{"chunks": [[start, end, jumlah_token], ...], "postings": {term: [[chunk_id, tf], ...]}, "len": total_token}
+        atau None kalau teksnya tidak ada di corpus store."""
+        entry = self.docs.get(doc_id)
+        if entry is not None: return entry
+        path = os.path.join(self.root, f"{doc_id}.json")
+        try:
+            with open(path, "r", encoding="utf-8") as f: entry = json.load(f)
+        except (OSError, ValueError):
+            try: text = get_corpus_store().get(doc_id)
+            except KeyError: return None
+            chunks = []; postings = {}
+            for s, e in chunk_spans(text, 0, len(text)):
+                tf = Counter(tokenize(text[s:e]))
+                for t, c in tf.items(): postings.setdefault(t, []).append([len(chunks), c])
+                chunks.append([s, e, sum(tf.values())])
+            entry = {"chunks": chunks, "postings": postings, "len": sum(c[2] for c in chunks)}
+            try:
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f: json.dump(entry, f)
+                os.replace(tmp, path)
+            except Exception as e: record_metric("cache_error", namespace="postings", error=str(e)[:300])
+        with self.lock: return self.docs.setdefault(doc_id, entry)
+
+@st.cache_resource
+def get_doc_index():
+    return DocIndex(CORPUS_DIR)
+
+class Bm25Index:
+    """Index BM25 satu user: hanya daftar doc_id. Postings per dokumen dipegang DocIndex bersama dan
+    digabung saat query, jadi statistik (N, avgdl, df) tetap atas seluruh dokumen user."""
+    def __init__(self, docs=()):
+        self.docs = dict(docs)      # doc_id -> nama sumber
+
+    def add(self, doc_id, name):
+        if doc_id in self.docs: return True
+        if get_doc_index().get(doc_id) is None: return False
+        self.docs[doc_id] = name; return True
+
+    def parts(self):
+        shared = get_doc_index()
+        return [(name, doc_id, d) for doc_id, name in list(self.docs.items()) if (d := shared.get(doc_id))]
+
+    @property
+    def chunks(self):
+        return [[name, doc_id, *c] for name, doc_id, d in self.parts() for c in d["chunks"]]   # [sumber, doc_id, start, end, jumlah_token]
+
+    def search(self, query, top_k=3):
+        parts = self.parts()
+        n = sum(len(d["chunks"]) for *_, d in parts)
+        if not n: return []
+        avg = sum(d["len"] for *_, d in parts) / n or 1; scores = {}
+        for t in set(tokenize(query)):
+            plists = [(i, d["postings"][t]) for i, (*_, d) in enumerate(parts) if t in d["postings"]]
+            df = sum(len(p) for _, p in plists)
+            if not df: continue
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for i, plist in plists:
+                chunks = parts[i][2]["chunks"]
+                for cid, tf in plist:
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * chunks[cid][2] / avg)
+                    scores[i, cid] = scores.get((i, cid), 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        best = heapq.nlargest(top_k, scores.items(), key=lambda x: x[1])
+        return [([parts[i][0], parts[i][1], *parts[i][2]["chunks"][cid]], sc) for (i, cid), sc in best]
+
+def load_pdf_docs():
+    """Referensi dokumen user [[doc_id, nama], ...]; cache pdf_context lama dipindah ke corpus store."""
+    try: docs = [d for d in json.loads(load_from_disk("backup_pdf_docs.txt") or "[]") if isinstance(d, list)]
+    except: docs = []
+    legacy = load_from_disk(PDF_CACHE_FILE)
+    if legacy:
+        store = get_corpus_store(); known = {d[0] for d in docs}
+        for name, start, end in split_sources(legacy):
+            doc_id = store.put(legacy[start:end])
+            if doc_id not in known: docs.append([doc_id, name]); known.add(doc_id)
+        save_to_disk("backup_pdf_docs.txt", json.dumps(docs))
+        delete_file(PDF_CACHE_FILE)
+    return docs
+
+def sync_pdf_index():
+    """Tambahkan dokumen user yang belum ada di index sesi (postings-nya dibangun sekali di DocIndex)."""
+    idx = st.session_state['pdf_index']
+    for doc_id, name in st.session_state['pdf_docs']: idx.add(doc_id, name)
+    return idx
+
+def count_tokens(text):
+    """Perkiraan jumlah token Gemini tanpa panggilan API (kata & tanda baca, +30% untuk pecahan sub-kata)."""
+    return math.ceil(len(re.findall(r'\w+|[^\w\s]', text)) * 1.3)
+
+def chunk_sentences(doc_id, start, end):
+    """Kalimat satu potongan: ((teks, token, kata), ...) plus 3-gram kata untuk deteksi duplikat.
+    Aman di-cache per (doc_id, offset) karena isi corpus store tidak pernah berubah (lihat get_sentence_cache)."""
+    text = get_corpus_store().get(doc_id)[start:end]
+    sents = tuple((x, count_tokens(x), frozenset(tokenize(x))) for x in (" ".join(t.split()) for t in re.split(r'(?<=[.!?])\s+|\n\s*\n', text)) if x)
+    words = tokenize(text)
+    return sents, frozenset(hash(tuple(words[i:i + 3])) for i in range(max(1, len(words) - 2)))
+
+@st.cache_resource
+def get_sentence_cache():
+    # LRU dipegang per proses: fungsi di level skrip didefinisikan ulang (cache kosong) setiap rerun
+    return functools.lru_cache(maxsize=CONTEXT_CACHE_CHUNKS)(chunk_sentences)
+
+def context_budget(kind, extra=""):
+    return max(CONTEXT_MIN_TOKENS, CONTEXT_BUDGET.get(kind, CONTEXT_BUDGET["subbab"]) - count_tokens(extra))
+
+@timed_fn("retrieval")
+def retrieve_relevant_context(query, index, budget=CONTEXT_BUDGET["subbab"]):
+    """Konteks terkecil yang masih mencakup sub-bab: potongan BM25 berskor rendah & hampir-duplikat dibuang,
+    tiap potongan dipangkas ke kalimat yang memuat kata kunci, lalu diisi sampai `budget` token."""
+    hits = index.search(query, CONTEXT_CANDIDATES)
+    if hits: hits = [c for c, sc in hits if sc >= hits[0][1] * CONTEXT_MIN_SCORE]
+    else: hits = index.chunks[:3]       # tidak ada kata yang cocok: pakai awal dokumen
+    terms = set(tokenize(query)); used = 0; picked = []; shingles = []
+    for src, doc_id, s, e, _ in hits:
+        if used >= budget: break
+        try: sents, sh = get_sentence_cache()(doc_id, s, e)
+        except KeyError: continue
+        if any(len(sh & o) / (len(sh | o) or 1) > CONTEXT_DUP_SIM for o in shingles): continue
+        keep = [x for x in sents if x[2] & terms] or sents[:2]
+        out = []
+        for text, n, _ in keep:
+            if used + n > budget: break
+            out.append(text); used += n
+        if out: picked.append(f"[{src}]\n{' '.join(out)}"); shingles.append(sh)
+    record_metric("context", candidates=len(hits), passages=len(picked), tokens=used, budget=budget)
+    return "\n...".join(picked)
 
 # ==========================================
 # 6. EXPORT WORD
 # ==========================================
-def create_docx(text):
-    doc = Document()
-    style = doc.styles['Normal']
-    style.font.name = 'Times New Roman'; style.font.size = 12 * 12700
+def inline_runs(line):
+    runs = []
+    for pt in re.split(r'(\*\*.*?\*\*|\*.*?\*)', line):
+        if not pt: continue
+        if pt.startswith('**'): runs.append((pt[2:-2], "b"))
+        elif pt.startswith('*'): runs.append((pt[1:-1], "i"))
+        else: runs.append((pt, ""))
+    return runs
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def docx_blocks(text):
+    """Naskah markdown -> blok [(jenis, isi)]. Di-cache per isi, jadi bab yang tidak berubah tidak di-parse ulang."""
+    blocks = []
     for line in text.split('\n'):
         line = line.strip()
         if not line: continue
-        if line.startswith('# '): doc.add_heading(line.replace('# ','').replace('**',''), 0)
-        elif line.startswith('## '): doc.add_heading(line.replace('## ','').replace('**',''), 1)
-        elif line.startswith('### '): doc.add_heading(line.replace('### ','').replace('**',''), 2)
-        elif line.startswith('- '): 
-            p = doc.add_paragraph(style='List Bullet')
-            parts = re.split(r'(\*\*.*?\*\*|\*.*?\*)', line[2:])
-            for pt in parts:
-                if pt.startswith('**'): p.add_run(pt[2:-2]).bold = True
-                elif pt.startswith('*'): p.add_run(pt[1:-1]).italic = True
-                else: p.add_run(pt)
-        else:
-            p = doc.add_paragraph()
-            parts = re.split(r'(\*\*.*?\*\*|\*.*?\*)', line)
-            for pt in parts:
-                if pt.startswith('**'): p.add_run(pt[2:-2]).bold = True
-                elif pt.startswith('*'): p.add_run(pt[1:-1]).italic = True
-                else: p.add_run(pt)
+        if line.startswith('# '): blocks.append((0, line.replace('# ','').replace('**','')))
+        elif line.startswith('## '): blocks.append((1, line.replace('## ','').replace('**','')))
+        elif line.startswith('### '): blocks.append((2, line.replace('### ','').replace('**','')))
+        elif line.startswith('- '): blocks.append(("li", inline_runs(line[2:])))
+        else: blocks.append(("p", inline_runs(line)))
+    return blocks
+
+@st.cache_data(max_entries=32, show_spinner=False)
+@timed_fn("docx")
+def render_docx(texts):
+    """DOCX dari satu/lebih naskah. Hasil di-cache per isi (tuple naskah)."""
+    doc = Document()
+    style = doc.styles['Normal']
+    style.font.name = 'Times New Roman'; style.font.size = 12 * 12700
+    for text in texts:
+        for kind, body in docx_blocks(text):
+            if kind in (0, 1, 2): doc.add_heading(body, kind); continue
+            p = doc.add_paragraph(style='List Bullet') if kind == "li" else doc.add_paragraph()
+            for run_text, fmt in body:
+                r = p.add_run(run_text)
+                if fmt == "b": r.bold = True
+                elif fmt == "i": r.italic = True
     bio = BytesIO(); doc.save(bio); return bio.getvalue()
 
+def create_docx(text):
+    return render_docx((text,))
+
 def convert_all_to_docx(state):
-    full = ""
-    for k in ['naskah_bab1', 'naskah_bab2', 'naskah_bab3', 'naskah_bab4', 'naskah_bab5']:
-        if state.get(k): full += state[k] + "\n\n"
-    return create_docx(full)
+    return render_docx(tuple(state[k] for k in ['naskah_bab1', 'naskah_bab2', 'naskah_bab3', 'naskah_bab4', 'naskah_bab5'] if state.get(k)))
 
 # ==========================================
 # 7. LOAD STATE (BUG FIXED HERE)
 # ==========================================
 keys = ['naskah_bab1', 'naskah_bab2', 'naskah_bab3', 'naskah_bab4', 'naskah_bab5',
         'outline_bab1', 'outline_bab2', 'outline_bab3', 'outline_bab4', 'outline_bab5',
-        'judul_final', 'pdf_context', 'data_penelitian', 'search_results', 
-        'opsi_judul_generated', 'generated_formulas', 'bidang_ilmu'] # <-- 'generated_formulas' ADDED
+        'judul_final', 'pdf_docs', 'data_penelitian', 'search_results', 
+        'opsi_judul_generated', 'generated_formulas', 'bidang_ilmu', 'pdf_index', 'naskah_live'] # <-- 'generated_formulas' ADDED
 
 for k in keys:
     if k not in st.session_state:
-        if k == 'pdf_context': st.session_state[k] = load_from_disk(PDF_CACHE_FILE)
-        elif 'outline' in k or 'search' in k or 'opsi' in k or 'generated' in k: st.session_state[k] = []
-        elif k == 'bidang_ilmu': st.session_state[k] = "Kesehatan/Keperawatan"
+        if k == 'pdf_docs': st.session_state[k] = load_pdf_docs()
+        elif k == 'pdf_index': st.session_state[k] = Bm25Index()
+        elif 'outline' in k or 'search' in k:
+            try: st.session_state[k] = json.loads(load_from_disk(f"backup_{k}.txt") or "[]")
+            except: st.session_state[k] = []
+        elif 'opsi' in k or 'generated' in k: st.session_state[k] = []
+        elif k == 'bidang_ilmu': st.session_state[k] = load_from_disk("backup_bidang_ilmu.txt") or "Kesehatan/Keperawatan"
+        elif k == 'naskah_live': st.session_state[k] = {}
         else: st.session_state[k] = load_from_disk(f"backup_{k}.txt")
 
 # ==========================================
 # 8. UI & MAIN
 # ==========================================
-with st.sidebar:
+# Sidebar, tab riset, tiap bab, dan export adalah fragment: interaksi di satu bagian
+# hanya menjalankan ulang bagian itu. st.rerun() tanpa scope dipakai kalau bagian lain ikut berubah.
+def rerun_fragment():
+    # scope="fragment" hanya sah saat fragment rerun sendiri; di run penuh pakai rerun biasa
+    try: st.rerun(scope="fragment")
+    except st.errors.StreamlitAPIException: st.rerun()
+
+def queue_feedback(box=None):
+    """Callback on_wait untuk get_model: tampilkan posisi antrian AI, hilang begitu giliran tiba."""
+    box = box or st.empty()
+    def show(pos):
+        if pos is None: box.empty()
+        else: box.info(f"⏳ Server AI sedang ramai, posisi antrian Anda: {pos + 1}")
+    return show
+
+def submit_job(kind, label, fn, *args):
+    try: get_job_runner().submit(current_user(), kind, label, fn, *args)
+    except Exception as e: st.error(str(e)); return
+    rerun_fragment()   # fragment pengirim dijalankan ulang dan memasang pemantau job-nya sendiri
+
+def apply_pdf_job(res):
+    known = {d[0] for d in st.session_state['pdf_docs']}; added = 0
+    for doc_id, name in res:
+        if doc_id in known: continue
+        st.session_state['pdf_docs'].append([doc_id, name]); known.add(doc_id); added += 1
+    if added:
+        save_to_disk("backup_pdf_docs.txt", json.dumps(st.session_state['pdf_docs']))
+        sync_pdf_index()
+    st.toast(f"Sukses! {added} PDF baru tersimpan, {len(res) - added} duplikat dilewati.")
+
+def apply_search_job(res):
+    st.session_state['search_results'] = res
+    save_to_disk("backup_search_results.txt", json.dumps(res))
+
+def append_subbab(key_naskah, parts):
+    st.session_state[key_naskah] += "".join(f"\n\n## {sub}\n{text}" for sub, text in parts)
+    save_to_disk(f"backup_{key_naskah}.txt", st.session_state[key_naskah])
+    st.session_state[f"sync_w_{key_naskah}"] = True   # editor diisi ulang dari naskah
+
+def apply_write_job(res):
+    if not res["text"]: return
+    append_subbab(res["key"], [(res["sub"], res["text"] + ("" if res["done"] else "\n\n*[Dibatalkan]*"))])
+
+def apply_write_all_job(res):
+    append_subbab(res["key"], [(sub, text) for sub, text in zip(res["subs"], res["texts"]) if text])
+    if res["errors"]: st.warning(f"{len(res['errors'])} sub-bab gagal, klik Tulis Semua lagi untuk mengulang: " + "; ".join(res["errors"]))
+    skipped = sum(1 for t in res["texts"] if not t) - len(res["errors"])
+    if skipped > 0: st.info(f"{skipped} sub-bab belum ditulis (dibatalkan/terhenti), klik Tulis Semua lagi untuk melanjutkan.")
+
+JOB_APPLIERS = {"pdf": apply_pdf_job, "search": apply_search_job, "tulis": apply_write_job, "tulis_semua": apply_write_all_job}
+
+def apply_finished_jobs():
+    """Terapkan hasil job yang sudah selesai (juga yang selesai saat halaman ditutup/di-refresh)."""
+    runner = get_job_runner()
+    for job in runner.finished(current_user()):
+        try:
+            if job["status"] == "gagal": st.error(f"{job['label']} gagal: {job['error']}")
+            elif job["result"] is not None: JOB_APPLIERS[job["kind"]](job["result"]); st.toast(f"✅ {job['label']} selesai")
+            # Job yang berakhir tanpa hasil (gagal, Batal, server dimulai ulang) tetap menyumbang hasil sementaranya
+            if job["result"] is None and job["partial"] is not None: JOB_APPLIERS[job["kind"]](job["partial"])
+        except Exception as e: st.error(f"{job['label']}: hasil tidak bisa diterapkan ({e})")
+        finally: runner.mark_applied(job["id"])
+
+def own_jobs(kinds, prefix=""):
+    return [j for j in get_job_runner().active(current_user()) if j["kind"] in kinds and j["label"].startswith(prefix)]
+
+@st.fragment(run_every=JOB_POLL_SEC)
+def render_jobs_live(kinds, prefix=""):
+    # Progress, Batal, hasil sementara pencarian & teks yang sedang di-stream berganti di sini saja.
+    # Fragment bersarang tidak bisa menjalankan ulang fragment tab-nya, jadi hasil akhir (editor, tabel,
+    # status PDF di sidebar) diterapkan di run penuh; run itu juga menghentikan polling ini.
+    runner = get_job_runner(); user = current_user()
+    active = own_jobs(kinds, prefix)
+    if not active or runner.finished(user): st.rerun()
+    for job in active:
+        c1, c2 = st.columns([6, 1])
+        c1.progress(job["progress"] or 0.0, f"⏳ {job['label']} — {job['message'] or job['status']}")
+        if c2.button("⏹️ Batal", key=f"job_stop_{job['id']}", disabled=job["batal"]):
+            runner.cancel(user, job["id"]); rerun_fragment()
+        p = job["partial"]
+        if job["kind"] == "search" and p: st.dataframe(pd.DataFrame(p), hide_index=True)
+        if job["kind"] == "tulis" and isinstance(p, dict):
+            st.info(f"✍️ Sedang ditulis: {p['sub']}")
+            st.markdown(p["text"][-3000:] + " ▌")
+
+def render_jobs(kinds, prefix=""):
+    """Pemantau job milik satu bagian halaman, dipasang di fragment bagian itu hanya selama ada job
+    aktif (tidak ada polling saat menganggur). True kalau ada yang dipantau."""
+    if not own_jobs(kinds, prefix): return False
+    render_jobs_live(kinds, prefix); return True
+
+get_pdf_executor()   # fork worker PDF sekarang, dari thread skrip
+apply_finished_jobs()
+
+@st.fragment
+@timed_fn("fragment")
+def render_sidebar():
     st.markdown("## ⚙️ Control Panel")
     if st.button("⚠️ RESET PROYEK", type="primary"): perform_full_reset(); st.rerun()
     st.divider()
@@ -370,6 +1739,7 @@ with st.sidebar:
     if bidang != st.session_state['bidang_ilmu']: 
         st.session_state['bidang_ilmu'] = bidang
         save_to_disk("backup_bidang_ilmu.txt", bidang)
+        st.rerun()
 
     st.markdown("---")
     ide = st.text_area("Topik Awal:", height=70)
@@ -377,11 +1747,11 @@ with st.sidebar:
         if ide:
             with st.spinner("..."):
                 p = f"Buat 3 Judul Tesis {bidang} topik {ide}. Output List Python. TANPA BASA BASI."
-                try: st.session_state['opsi_judul_generated'] = clean_parse_list(get_model().generate_content(p).text)
+                try: st.session_state['opsi_judul_generated'] = clean_parse_list(get_model(on_wait=queue_feedback()).generate_content(p, cache=True, refresh=st.session_state.get('llm_refresh', False), kind="judul").text)
                 except Exception as e: st.error(str(e))
     if st.session_state['opsi_judul_generated']:
         pilihan = st.radio("Pilih:", st.session_state['opsi_judul_generated'])
-        if st.button("Pakai"): st.session_state['judul_final'] = pilihan; st.rerun()
+        if st.button("Pakai"): st.session_state['judul_final'] = pilihan; rerun_fragment()
 
     judul_input = st.text_area("Judul Final:", value=st.session_state['judul_final'], height=100)
     if judul_input != st.session_state['judul_final']:
@@ -390,28 +1760,39 @@ with st.sidebar:
 
     st.divider()
     pdfs = st.file_uploader("Upload PDF (Jurnal Acuan)", type=['pdf'], accept_multiple_files=True)
+    max_pages = st.number_input("Maks Halaman / PDF", 1, 2000, PDF_MAX_PAGES)
     if pdfs and st.button("Proses PDF"):
-        with st.spinner("Membaca..."):
-            raw = extract_text_from_pdfs(pdfs)
-            st.session_state['pdf_context'] += raw
-            save_to_disk(PDF_CACHE_FILE, st.session_state['pdf_context'])
-            st.success("Sukses! Data PDF tersimpan.")
-    if len(st.session_state['pdf_context']) > 100: st.success("✅ PDF Ready")
+        submit_job("pdf", f"Proses {len(pdfs)} PDF", job_process_pdfs, [PdfBlob(f.name, f.getvalue()) for f in pdfs], max_pages)
+    render_jobs(("pdf",))
+    if st.session_state['pdf_docs']: st.success("✅ PDF Ready")
+    st.toggle("⚡ Mode Streaming", value=True, key='stream_mode')
+    st.checkbox("🔄 Generate Ulang (abaikan cache AI)", key='llm_refresh')
+
+with st.sidebar: render_sidebar()
 
 st.markdown(f'<div class="main-header">🎓 Thesis Master V6.2</div>', unsafe_allow_html=True)
 st.markdown(f'<div class="sub-header">Mode: {st.session_state["bidang_ilmu"]} | Bug Fixed</div>', unsafe_allow_html=True)
 st.divider()
 
-tabs = st.tabs(["🔎 Riset", "BAB 1", "BAB 2", "BAB 3", "BAB 4", "BAB 5", "💾 Export"])
+is_admin = current_user() in ADMIN_USERS
+tabs = st.tabs(["🔎 Riset", "BAB 1", "BAB 2", "BAB 3", "BAB 4", "BAB 5", "💾 Export"] + (["📊 Metrics"] if is_admin else []))
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def results_to_excel(results):
+    out = BytesIO()
+    with pd.ExcelWriter(out, engine='openpyxl') as w: pd.DataFrame(results).to_excel(w, index=False)
+    return out.getvalue()
 
-with tabs[0]:
+@st.fragment
+@timed_fn("fragment")
+def render_riset():
     st.header("🔎 Pencarian Jurnal")
     
     with st.expander("💡 Rekomendasi Rumus Boolean (Klik Disini)"):
         if st.button("✨ Generate Rumus Canggih"):
             if st.session_state['judul_final']:
                 with st.spinner("Meracik rumus..."):
-                    forms = generate_search_formulas(st.session_state['judul_final'], st.session_state['bidang_ilmu'])
+                    forms = generate_search_formulas(st.session_state['judul_final'], st.session_state['bidang_ilmu'], st.session_state.get('llm_refresh', False), queue_feedback())
                     st.session_state['generated_formulas'] = forms
         
         if st.session_state.get('generated_formulas'):
@@ -428,28 +1809,46 @@ with tabs[0]:
     ft_only = c_ft.checkbox("Hanya Fulltext Link")
     
     if st.button("Cari Jurnal"):
-        with st.spinner(f"Mencari data..."):
-            st.session_state['search_results'] = smart_search_dispatcher(st.session_state['bidang_ilmu'], kw, lim, age, oa_only, ft_only)
+        submit_job("search", f"Cari: {kw[:40]}", job_search, current_user(), st.session_state['bidang_ilmu'], kw, lim, age, oa_only, ft_only)
             
-    if st.session_state['search_results']:
+    # Selama pencarian jalan, hasil sementara per halaman menggantikan tabel hasil
+    if not render_jobs(("search",)) and st.session_state['search_results']:
         df = pd.DataFrame(st.session_state['search_results'])
         if df.empty:
             st.warning("Tidak ditemukan. Coba keyword yang lebih sederhana.")
         else:
             st.success(f"Ditemukan {len(df)} jurnal.")
             st.dataframe(df, hide_index=True)
-            try:
-                out = BytesIO(); 
-                with pd.ExcelWriter(out, engine='openpyxl') as w: df.to_excel(w, index=False)
-                st.download_button("📥 Excel", out.getvalue(), "jurnal.xlsx")
+            try: st.download_button("📥 Excel", results_to_excel(st.session_state['search_results']), "jurnal.xlsx")
             except: st.error("Install openpyxl")
 
-def render_bab(key_naskah, key_outline, label, extra=""):
+    st.divider()
+    lib = get_reference_library()
+    st.subheader("📚 Pustaka Referensi")
+    c_q, c_scope = st.columns([3, 1])
+    lq = c_q.text_input("Cari di pustaka (judul / penulis):", key="lib_query", help="Tanpa koneksi internet & tanpa kuota API.")
+    shared = c_scope.toggle("Semua user", key="lib_shared")
+    user = None if shared else current_user()
+    found = lib.search(lq, user)
+    st.caption(f"{len(found)} ditampilkan dari {lib.count(user)} referensi {'bersama' if shared else 'milik Anda'}.")
+    if found: st.dataframe(pd.DataFrame(found), hide_index=True)
+
+with tabs[0]: render_riset()
+
+def subbab_spec(key_naskah, extra):
+    """Bahan prompt sub-bab yang hanya ada di sesi. Ringkasan bab sebelumnya & konteks PDF dihitung di job."""
+    return {"bidang": st.session_state['bidang_ilmu'], "judul": st.session_state['judul_final'], "extra": extra() if extra else "",
+            "chapters": [st.session_state[k] for k in CHAPTER_KEYS[:CHAPTER_KEYS.index(key_naskah)]], "index": sync_pdf_index()}
+
+def render_bab(key_naskah, key_outline, label, extra=None):
     c1, c2 = st.columns([1,3])
     wk = f"w_{key_naskah}"
-    if wk in st.session_state and st.session_state[wk] != st.session_state[key_naskah]:
+    if st.session_state.pop(f"sync_{wk}", False):
+        st.session_state[wk] = st.session_state[key_naskah]
+    elif wk in st.session_state and st.session_state[wk] != st.session_state[key_naskah]:
         st.session_state[key_naskah] = st.session_state[wk]
         save_to_disk(f"backup_{key_naskah}.txt", st.session_state[key_naskah])
+    st.session_state['naskah_live'][key_naskah] = st.session_state[key_naskah]
 
     with c1:
         st.markdown(f"**Struktur {label}**")
@@ -457,68 +1856,138 @@ def render_bab(key_naskah, key_outline, label, extra=""):
             if not st.session_state['judul_final']: st.error("Isi Judul dulu!"); return
             with st.spinner("..."):
                 p = f"Buat Outline {label} Tesis: '{st.session_state['judul_final']}'. Bidang: {st.session_state['bidang_ilmu']}. List Python."
-                try: st.session_state[key_outline] = clean_parse_list(get_model().generate_content(p).text)
+                try: st.session_state[key_outline] = clean_parse_list(get_model(on_wait=queue_feedback()).generate_content(p, cache=True, refresh=st.session_state.get('llm_refresh', False), kind="outline").text)
                 except Exception as e: st.error(str(e))
         if st.session_state[key_outline]:
             t = st.text_area("Edit Outline:", "\n".join(st.session_state[key_outline]), height=300, key=f"t_{key_outline}")
             st.session_state[key_outline] = [x.strip() for x in t.split('\n') if x.strip()]
+        outline_json = json.dumps(st.session_state[key_outline])
+        if st.session_state.get(f"saved_{key_outline}") != outline_json:
+            if f"saved_{key_outline}" in st.session_state: save_to_disk(f"backup_{key_outline}.txt", outline_json)
+            st.session_state[f"saved_{key_outline}"] = outline_json
         
         st.divider()
         if st.button(f"🗑️ Reset {label}", key=f"rst_{key_naskah}", type="secondary"):
             st.session_state[key_naskah] = ""
             save_to_disk(f"backup_{key_naskah}.txt", "")
-            st.rerun()
+            rerun_fragment()
+        if st.button(f"🕘 Riwayat", key=f"h_{key_naskah}"):
+            st.session_state[f"hist_{key_naskah}"] = get_project_store().history(current_user(), key_naskah, 10)
+        hist = st.session_state.get(f"hist_{key_naskah}")
+        if hist:
+            i = st.selectbox("Versi sebelum:", range(len(hist)), key=f"hv_{key_naskah}",
+                             format_func=lambda i: datetime.datetime.fromtimestamp(hist[i][0]).strftime("%d/%m %H:%M:%S"))
+            if st.button("↩️ Pulihkan", key=f"hr_{key_naskah}"):
+                st.session_state[key_naskah] = st.session_state[wk] = hist[i][1]
+                save_to_disk(f"backup_{key_naskah}.txt", hist[i][1])
+                del st.session_state[f"hist_{key_naskah}"]; rerun_fragment()
 
     with c2:
         st.markdown(f"**Editor {label}**")
         if st.session_state[key_naskah]:
-            st.download_button(f"📥 DOWNLOAD {label}", create_docx(st.session_state[key_naskah]), f"{label}.docx", type="primary")
+            st.download_button(f"📥 DOWNLOAD {label}", lambda text=st.session_state[key_naskah]: create_docx(text), f"{label}.docx", type="primary")
         
         st.divider()
-        sub = ""
+        sub = ""; go = go_all = False
         if st.session_state[key_outline]:
             c_sel, c_btn = st.columns([3,1])
             with c_sel: sub = st.selectbox("Pilih Sub-Bab:", st.session_state[key_outline], key=f"s_{key_naskah}")
-            with c_btn: 
-                if st.button(f"🚀 Tulis", key=f"g_{key_naskah}"):
-                    with st.spinner("Menulis..."):
-                        ctx = retrieve_relevant_context(sub, st.session_state['pdf_context'])
-                        
-                        p = f"""
-                        Peran: Penulis Tesis Akademik ({st.session_state['bidang_ilmu']}).
-                        Topik Sub-Bab: '{sub}'. Judul: {st.session_state['judul_final']}.
-                        
-                        DATA PENDUKUNG (CONTEXT):
-                        {ctx}
-                        {extra}
-                        
-                        INSTRUKSI KHUSUS (WAJIB DIPATUHI):
-                        1. FILTER TAHUN CERDAS: Jika ada data di 'Context' yang tahunnya < 2015, JANGAN jadikan argumen utama.
-                        2. SITASI CERDAS: Gunakan format APA (Nama, Tahun). DILARANG KERAS menggunakan angka [1].
-                        3. GAYA BAHASA HUMANIS: Tulis dengan gaya natural manusia, variasi kalimat, hindari kata robotik.
-                        4. NO PROLOG.
-                        5. Panjang: 600-900 kata.
-                        """
-                        try:
-                            res = get_model().generate_content(p).text
-                            st.session_state[key_naskah] += f"\n\n## {sub}\n{res}"
-                            st.session_state[wk] = st.session_state[key_naskah]
-                            save_to_disk(f"backup_{key_naskah}.txt", st.session_state[key_naskah])
-                            st.success("Selesai!"); time.sleep(0.5); st.rerun()
-                        except Exception as e: st.error(str(e))
+            with c_btn:
+                go = st.button(f"🚀 Tulis", key=f"g_{key_naskah}")
+                go_all = st.button(f"📚 Tulis Semua", key=f"ga_{key_naskah}")
+        if go_all:
+            # Sub-bab yang sudah ada di naskah dilewati; sisanya ditulis paralel lalu disusun sesuai outline
+            subs = [x for x in st.session_state[key_outline] if f"## {x}\n" not in st.session_state[key_naskah]]
+            if subs:
+                submit_job("tulis_semua", f"{label}: {len(subs)} sub-bab", job_write_all, current_user(), key_naskah, subs, subbab_spec(key_naskah, extra))
+            else: st.info("Semua sub-bab sudah ditulis.")
+        if go:
+            # State sesi diambil sekarang; ringkasan bab sebelumnya, prompt, dan generate jalan di job
+            submit_job("tulis", f"{label}: {sub}", job_write_subbab, current_user(), key_naskah, sub, subbab_spec(key_naskah, extra), st.session_state.get('stream_mode', True))
         
+        render_jobs(("tulis", "tulis_semua"), f"{label}: ")
         st.text_area("Isi Naskah:", value=st.session_state[key_naskah], height=600, key=wk)
 
-with tabs[1]: render_bab('naskah_bab1', 'outline_bab1', 'BAB 1')
-with tabs[2]: render_bab('naskah_bab2', 'outline_bab2', 'BAB 2')
-with tabs[3]: render_bab('naskah_bab3', 'outline_bab3', 'BAB 3')
-with tabs[4]: 
+@st.fragment
+@timed_fn("fragment")
+def render_bab_tab(key_naskah, key_outline, label, extra=None):
+    # extra berupa fungsi, baru dibaca saat sub-bab ditulis (nilai terbaru walau fragment rerun sendiri)
+    render_bab(key_naskah, key_outline, label, extra)
+
+@st.fragment
+@timed_fn("fragment")
+def render_bab4_tab():
     col_d1, col_d2 = st.columns(2)
     with col_d1:
-        if st.button("🎲 Data Dummy"): st.session_state['data_penelitian'] = "Tabel 1: X=40%, Y=60%, p=0.003"; st.rerun()
+        if st.button("🎲 Data Dummy"):
+            st.session_state['data_penelitian'] = "Tabel 1: X=40%, Y=60%, p=0.003"
+            save_to_disk("backup_data_penelitian.txt", st.session_state['data_penelitian']); rerun_fragment()
     d_in = st.text_area("Data:", st.session_state['data_penelitian'])
-    st.session_state['data_penelitian'] = d_in
-    render_bab('naskah_bab4', 'outline_bab4', 'BAB 4', f"DATA: {d_in}")
-with tabs[5]: render_bab('naskah_bab5', 'outline_bab5', 'BAB 5', f"Ringkasan: {st.session_state['naskah_bab4'][:1000]}")
-with tabs[6]:
-    st.download_button("📥 DOWNLOAD FULL TESIS", convert_all_to_docx(st.session_state), "Tesis_Full.docx", type="primary")
\ No newline at end of file
+    if d_in != st.session_state['data_penelitian']:
+        st.session_state['data_penelitian'] = d_in
+        save_to_disk("backup_data_penelitian.txt", d_in)
+    render_bab('naskah_bab4', 'outline_bab4', 'BAB 4', lambda: f"DATA: {st.session_state['data_penelitian']}")
+
+@st.fragment
+@timed_fn("fragment")
+def render_export():
+    # Naskah dibaca dari naskah_live saat tombol diklik (callable jalan di thread lain, tanpa st.session_state)
+    live = st.session_state['naskah_live']
+    st.download_button("📥 DOWNLOAD FULL TESIS", lambda: convert_all_to_docx(dict(live)), "Tesis_Full.docx", type="primary")
+
+with tabs[1]: render_bab_tab('naskah_bab1', 'outline_bab1', 'BAB 1')
+with tabs[2]: render_bab_tab('naskah_bab2', 'outline_bab2', 'BAB 2')
+with tabs[3]: render_bab_tab('naskah_bab3', 'outline_bab3', 'BAB 3')
+with tabs[4]: render_bab4_tab()
+with tabs[5]: render_bab_tab('naskah_bab5', 'outline_bab5', 'BAB 5')
+with tabs[6]: render_export()
+
+def load_metrics(limit=METRICS_PANEL_ROWS):
+    rows = []
+    try:
+        with open(METRICS_FILE, "r", encoding="utf-8") as f: lines = deque(f, maxlen=limit)
+    except OSError: lines = []
+    for line in lines:
+        try: rows.append(json.loads(line))
+        except ValueError: pass
+    return pd.DataFrame(rows)
+
+@st.fragment
+def render_metrics():
+    st.header("📊 Metrik Performa")
+    st.button("🔄 Muat Ulang")
+    st.subheader("Status API Key")
+    st.dataframe(pd.DataFrame(get_key_scheduler(tuple(k for k in API_KEYS_POOL if "MASUKKAN" not in k)).snapshot()), hide_index=True)
+    st.subheader("Antrian Generate")
+    q = get_generation_service().snapshot()
+    if q: st.dataframe(pd.DataFrame(q), hide_index=True)
+    else: st.caption(f"Kosong ({LLM_WORKERS} worker, maks {LLM_USER_CONCURRENCY} interaktif + {LLM_BATCH_CONCURRENCY} batch per user).")
+    df = load_metrics()
+    if df.empty: st.info("Belum ada data metrik."); return
+    for col in ["ms", "prompt", "source", "name", "key", "error", "tokens_in", "tokens_out"]:
+        if col not in df: df[col] = None
+    df["detail"] = df["prompt"].fillna(df["source"]).fillna(df["name"]).fillna("")
+    st.caption(f"{len(df)} kejadian sejak {datetime.datetime.fromtimestamp(df['ts'].min()):%d/%m %H:%M}")
+
+    st.subheader("Latensi (ms)")
+    lat = df[df["ms"].notna()]
+    q = lambda p: (lambda x: x.quantile(p))
+    summary = lat.groupby(["kind", "detail"])["ms"].agg(n="count", p50=q(.5), p90=q(.9), p99=q(.99), max="max")
+    st.dataframe(summary.round(1))
+
+    llm = df[df["kind"] == "llm"]
+    if not llm.empty:
+        st.subheader("Token LLM per Key & Jenis Prompt")
+        st.dataframe(llm.groupby(["key", "prompt"]).agg(n=("ms", "count"), p50_ms=("ms", "median"), tokens_in=("tokens_in", "sum"), tokens_out=("tokens_out", "sum")))
+    if "pages_per_sec" in df:
+        pdf = df[df["kind"] == "pdf"]
+        if not pdf.empty: st.metric("Ekstraksi PDF (median halaman/dtk)", f"{pdf['pages_per_sec'].median():.1f}")
+
+    err = df[df["error"].notna()]
+    st.subheader(f"Error Terakhir ({len(err)})")
+    st.dataframe(err[["ts", "kind", "detail", "key", "error"]].tail(50).iloc[::-1], hide_index=True)
+
+if is_admin:
+    with tabs[7]: render_metrics()
+
+record_metric("rerun", ms=round((time.perf_counter() - RUN_T0) * 1000, 1))
@@ -0,0 +1,354 @@
+"""Benchmark offline Thesis Master: tanpa kuota Gemini, tanpa NCBI/Crossref.
+
+Fungsi aplikasi diambil langsung dari Ths.V6.py (definisi top-level saja, UI tidak dijalankan),
+lalu diarahkan ke server HTTP lokal yang memutar ulang respon rekaman di bench/fixtures dan ke
+backend `generate_content` palsu. Latensi dan rasio 429 bisa diatur.
+
+    python bench/run_bench.py
+    python bench/run_bench.py --workloads search,llm --users 1,8,32 --latency-ms 300 --rate-429 0.05
+    python bench/run_bench.py --json hasil_sebelum.json
+"""
+import argparse
+import ast
+import copy
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+import warnings
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import urlparse, parse_qs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILE = os.path.join(ROOT, "Ths.V6.py")
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+WORKLOADS = ("search", "llm", "llm_stream", "pdf", "retrieval", "docx")
+
+WORDS = ("pasien diabetes edukasi kepatuhan obat kualitas hidup perawat intervensi kontrol glikemik "
+         "dukungan sosial efikasi diri puskesmas lansia hipertensi aktivitas fisik pola makan "
+         "telemonitoring insulin self management education adherence outcome cohort randomised "
+         "analysis regression sample questionnaire validity reliability community primary care").split()
+
+# ==========================================
+# 1. MEMUAT APLIKASI
+# ==========================================
+def is_const(target):
+    if isinstance(target, ast.Name): return target.id.isupper()
+    if isinstance(target, ast.Tuple): return all(is_const(t) for t in target.elts)
+    return False
+
+def load_app(overrides):
+    """Modul `thesis_app` berisi import, konstanta, fungsi & kelas Ths.V6.py (tanpa eksekusi UI)."""
+    with open(APP_FILE, encoding="utf-8") as f: tree = ast.parse(f.read(), APP_FILE)
+    if ROOT not in sys.path: sys.path.insert(0, ROOT)    # modul pendamping (pdf_worker) seperti saat `streamlit run`
+    keep = [n for n in tree.body if isinstance(n, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef))
+            or (isinstance(n, ast.Assign) and all(is_const(t) for t in n.targets))]
+    warnings.filterwarnings("ignore", category=FutureWarning)   # peringatan deprecation google.generativeai
+    import streamlit
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"): logging.getLogger(name).setLevel(logging.ERROR)
+    mod = types.ModuleType("thesis_app"); mod.__file__ = APP_FILE
+    sys.modules["thesis_app"] = mod   # worker PDF (fork) mencari fungsi lewat nama modul
+    exec(compile(ast.Module(body=keep, type_ignores=[]), APP_FILE, "exec"), mod.__dict__)
+    for k, v in overrides.items(): setattr(mod, k, v)
+    return mod
+
+# ==========================================
+# 2. SERVER HTTP PALSU (PubMed & Crossref)
+# ==========================================
+class FakeApi:
+    """Memutar ulang rekaman esearch/esummary/works dengan latensi & rasio 429 yang bisa diatur."""
+    def __init__(self, latency_ms, jitter_ms, rate_429, count=2000, seed=0):
+        self.latency = latency_ms / 1000; self.jitter = jitter_ms / 1000
+        self.rate_429 = rate_429; self.count = count
+        self.rng = random.Random(seed); self.lock = threading.Lock()
+        self.hits = {}
+        with open(os.path.join(FIXTURES, "esearch.json"), encoding="utf-8") as f: self.esearch = json.load(f)
+        self.docsums = ET.parse(os.path.join(FIXTURES, "esummary.xml")).getroot().findall("DocSum")
+        with open(os.path.join(FIXTURES, "crossref_works.json"), encoding="utf-8") as f: self.works = json.load(f)
+
+    def roll(self, path):
+        with self.lock:
+            self.hits[path] = self.hits.get(path, 0) + 1
+            return self.latency + self.rng.uniform(0, self.jitter), self.rng.random() < self.rate_429
+
+    def esearch_body(self, q):
+        body = copy.deepcopy(self.esearch); res = body["esearchresult"]
+        res["count"] = str(self.count); res["webenv"] = f"MCID_bench_{abs(hash(q.get('term', [''])[0])) % 10**8}"
+        return json.dumps(body).encode(), "application/json"
+
+    def esummary_body(self, q):
+        start = int(q.get("retstart", ["0"])[0]); n = min(int(q.get("retmax", ["20"])[0]), max(0, self.count - start))
+        root = ET.Element("eSummaryResult")
+        for i in range(start, start + n):
+            doc = copy.deepcopy(self.docsums[i % len(self.docsums)])
+            doc.find("Id").text = str(30000000 + i)
+            for it in doc.iter("Item"):
+                if it.get("Name") == "Title": it.text = f"{it.text} [{q['WebEnv'][0]}/{i}]"
+                elif it.get("Name") in ("DOI", "doi"): it.text = f"{it.text}.{i}"   # record unik (dedup DOI)
+            root.append(doc)
+        return b'<?xml version="1.0" encoding="UTF-8" ?>\n' + ET.tostring(root), "text/xml"
+
+    def works_body(self, q):
+        # Meniru deep paging cursor ("*" lalu next-cursor) dan filter has-full-text / has-license di server
+        rows = int(q.get("rows", ["20"])[0]); cursor = q.get("cursor", [None])[0]; filt = q.get("filter", [""])[0]
+        offset = int(cursor[1:]) if cursor and cursor != "*" else int(q.get("offset", ["0"])[0])
+        body = copy.deepcopy(self.works); items = []
+        tpl = [it for it in body["message"]["items"] if ("has-full-text:true" not in filt or "link" in it)
+               and ("has-license:true" not in filt or "license" in it)]
+        for i in range(offset, min(offset + rows, self.count)):
+            it = copy.deepcopy(tpl[i % len(tpl)])
+            it["DOI"] = f"{it['DOI']}.{i}"; it["title"] = [f"{it['title'][0]} [{q.get('query', [''])[0]}/{i}]"]
+            items.append(it)
+        body["message"].update({"items": items, "items-per-page": rows, "total-results": self.count})
+        if cursor: body["message"]["next-cursor"] = f"c{offset + rows}"
+        return json.dumps(body).encode(), "application/json"
+
+    def serve(self):
+        api = self
+        routes = {"/esearch.fcgi": (self.esearch_body, b'{"error":"API rate limit exceeded","count":"11","limit":"10"}'),
+                  "/esummary.fcgi": (self.esummary_body, b'{"error":"API rate limit exceeded","count":"11","limit":"10"}'),
+                  "/works": (self.works_body, b"Too Many Requests")}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *a): pass
+            def do_GET(self):
+                url = urlparse(self.path); route = routes.get(url.path)
+                if route is None: return self.reply(404, b"not found", "text/plain")
+                delay, limited = api.roll(url.path); time.sleep(delay)
+                if limited: return self.reply(429, route[1], "application/json" if route[1][:1] == b"{" else "text/plain")
+                self.reply(200, *route[0](parse_qs(url.query)))
+            def reply(self, code, body, ctype):
+                self.send_response(code); self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body))); self.end_headers(); self.wfile.write(body)
+
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler); httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd, f"http://127.0.0.1:{httpd.server_address[1]}"
+
+# ==========================================
+# 3. BACKEND GEMINI PALSU
+# ==========================================
+class FakeChunk:
+    def __init__(self, text): self.text = text
+
+class FakeUsage:
+    def __init__(self, prompt, text): self.prompt_token_count = len(prompt) // 4; self.candidates_token_count = len(text) // 4
+
+class FakeResponse(FakeChunk):
+    def __init__(self, prompt, text): super().__init__(text); self.usage_metadata = FakeUsage(prompt, text)
+
+class FakeGenAI:
+    """Pengganti modul google.generativeai: latensi per request (+ per chunk saat stream) dan 429 acak."""
+    def __init__(self, latency_ms, jitter_ms, rate_429, out_chars=3000, chunks=20, seed=0):
+        self.latency = latency_ms / 1000; self.jitter = jitter_ms / 1000
+        self.rate_429 = rate_429; self.out_chars = out_chars; self.chunks = chunks
+        self.rng = random.Random(seed); self.lock = threading.Lock(); self.calls = 0
+
+    def list_models(self, client=None, **kw):
+        return [types.SimpleNamespace(name="models/gemini-1.5-flash", supported_generation_methods=["generateContent"])]
+
+    def GenerativeModel(self, name, safety_settings=None, **kw):
+        api = self
+        class Model:
+            def generate_content(self, prompt, stream=False):
+                with api.lock:
+                    api.calls += 1
+                    delay, limited = api.latency + api.rng.uniform(0, api.jitter), api.rng.random() < api.rate_429
+                if limited: time.sleep(delay / 10); raise Exception("429 Resource has been exhausted (e.g. check quota).")
+                text = " ".join(WORDS[i % len(WORDS)] for i in range(api.out_chars // 8))[:api.out_chars]
+                if not stream: time.sleep(delay); return FakeResponse(prompt, text)
+                def gen():
+                    step = max(1, len(text) // api.chunks)
+                    for i in range(0, len(text), step): time.sleep(delay / api.chunks); yield FakeChunk(text[i:i + step])
+                return gen()
+        return Model()
+
+class FakeGlm:
+    """Pengganti google.ai.generativelanguage: client per key tanpa koneksi gRPC."""
+    class GenerativeServiceClient:
+        def __init__(self, client_options=None): self.client_options = client_options
+    ModelServiceClient = GenerativeServiceClient
+
+# ==========================================
+# 4. DATA SINTETIS
+# ==========================================
+def fake_text(rng, n_words):
+    out = []
+    for i in range(n_words):
+        out.append(rng.choice(WORDS))
+        if i % 14 == 13: out[-1] += "."
+    return " ".join(out)
+
+def pdf_escape(s):
+    return s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def make_pdf(pages):
+    """PDF minimal (Helvetica, satu content stream per halaman) yang teksnya bisa diekstrak PyPDF2."""
+    n = len(pages)
+    objs = [b"<< /Type /Catalog /Pages 2 0 R >>",
+            f"<< /Type /Pages /Kids [{' '.join(f'{4 + 2 * i} 0 R' for i in range(n))}] /Count {n} >>".encode(),
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for i, text in enumerate(pages):
+        words = text.split(); lines = [" ".join(words[j:j + 14]) for j in range(0, len(words), 14)]
+        data = ("BT /F1 10 Tf 12 TL 50 800 Td " + " ".join(f"({pdf_escape(l)}) '" for l in lines) + " ET").encode("latin-1")
+        objs.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>".encode())
+        objs.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(data), data))
+    out = BytesIO(); out.write(b"%PDF-1.4\n"); offsets = []
+    for i, o in enumerate(objs, 1):
+        offsets.append(out.tell()); out.write(b"%d 0 obj\n%s\nendobj\n" % (i, o))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1))
+    for off in offsets: out.write(b"%010d 00000 n \n" % off)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, xref))
+    return out.getvalue()
+
+class Upload(BytesIO):
+    """Meniru UploadedFile Streamlit (name + getvalue)."""
+    def __init__(self, name, data): super().__init__(data); self.name = name
+
+def fake_chapter(rng, subs):
+    parts = ["# BAB II TINJAUAN PUSTAKA"]
+    for i in range(subs):
+        parts.append(f"## 2.{i + 1} {fake_text(rng, 4).title()}")
+        for _ in range(6): parts.append(f"**{rng.choice(WORDS)}** {fake_text(rng, 110)} *{rng.choice(WORDS)}*.")
+        parts += [f"- {fake_text(rng, 12)}" for _ in range(3)]
+    return "\n\n".join(parts)
+
+# ==========================================
+# 5. RUNNER & LAPORAN
+# ==========================================
+def percentile(sorted_vals, p):
+    if not sorted_vals: return None
+    return sorted_vals[min(len(sorted_vals) - 1, max(0, int(round(p / 100 * len(sorted_vals) + 0.5)) - 1))]
+
+def run_ops(users, ops):
+    """Jalankan `ops` (list callable, dibagi rata per user) dengan `users` thread bersamaan."""
+    lat = []; errors = []; lock = threading.Lock()
+    def user(batch):
+        for op in batch:
+            t0 = time.perf_counter()
+            try: op()
+            except Exception as e:
+                with lock: errors.append(str(e)[:200])
+                continue
+            with lock: lat.append((time.perf_counter() - t0) * 1000)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as ex: list(ex.map(user, [ops[i::users] for i in range(users)]))
+    wall = time.perf_counter() - t0; lat.sort()
+    return {"ops": len(ops), "errors": len(errors), "wall_s": round(wall, 3),
+            "ops_per_s": round(len(lat) / wall, 2) if wall else None,
+            "p50_ms": percentile(lat, 50), "p90_ms": percentile(lat, 90), "p99_ms": percentile(lat, 99),
+            "error_sample": errors[0] if errors else ""}
+
+def bench_search(app, size, users, args, rng, tag):
+    # size = jumlah hasil per pencarian; keyword unik per op (tanpa cache) kecuali --search-repeat
+    distinct = max(1, int(users * args.ops * (1 - args.search_repeat)))
+    ops = [lambda i=i: app.smart_search_dispatcher("Kesehatan", f"{tag} topik {i % distinct}", size, 10, args.search_oa_ft, args.search_oa_ft)
+           for i in range(users * args.ops)]
+    return run_ops(users, ops)
+
+def bench_llm(app, size, users, args, rng, tag, stream=False):
+    # tiap thread = satu user di antrian generate (giliran adil & batas paralel per user ikut terukur)
+    app.get_key_scheduler.clear(); models = [app.get_model(user=f"{tag}_user{u}") for u in range(users)]
+    def op(i):
+        model = models[i % users]; p = f"{tag} prompt {i}: " + fake_text(rng, 50 * size)
+        if stream: return "".join(model.stream_text(p, kind="bench"))
+        return model.generate_content(p, kind="bench").text
+    return run_ops(users, [lambda i=i: op(i) for i in range(users * args.ops)])
+
+def bench_pdf(app, size, users, args, rng, tag):
+    # size = jumlah PDF per upload; tiap op = satu upload dari satu user (PDF unik, cache miss)
+    uploads = [[Upload(f"{tag}_{u}_{k}_{j}.pdf", make_pdf([f"{tag} {u} {k} {j} {p} " + fake_text(rng, 350) for p in range(args.pdf_pages)]))
+                for j in range(size)] for u in range(users) for k in range(args.ops)]
+    return run_ops(users, [lambda up=up: app.extract_text_from_pdfs(up, max_pages=args.pdf_pages) for up in uploads])
+
+def bench_retrieval(app, size, users, args, rng, tag):
+    # size = jumlah dokumen (~pdf_pages x 2.5 rb karakter) di index user
+    store = app.get_corpus_store(); index = app.Bm25Index()
+    t0 = time.perf_counter()
+    for j in range(size):
+        text = f"{tag} {j} " + fake_text(rng, 350 * args.pdf_pages)
+        index.add(store.put(text), f"{tag}_{j}.pdf")
+    build = round((time.perf_counter() - t0) * 1000, 1)
+    ops = [lambda: app.retrieve_relevant_context(fake_text(rng, 12), index) for _ in range(users * args.ops)]
+    res = run_ops(users, ops); res["index_build_ms"] = build; res["chunks"] = len(index.chunks)
+    return res
+
+def bench_docx(app, size, users, args, rng, tag):
+    # size = jumlah sub-bab per naskah; naskah unik per op supaya cache render tidak kena
+    texts = [f"{tag} {i}\n\n" + fake_chapter(rng, size) for i in range(users * args.ops)]
+    return run_ops(users, [lambda t=t: app.create_docx(t) for t in texts])
+
+BENCHES = {"search": bench_search, "llm": bench_llm, "pdf": bench_pdf, "retrieval": bench_retrieval, "docx": bench_docx,
+           "llm_stream": lambda *a: bench_llm(*a, stream=True)}
+
+def csv_ints(s): return [int(x) for x in s.split(",") if x.strip()]
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark offline Thesis Master (server & Gemini palsu).")
+    ap.add_argument("--workloads", default=",".join(WORKLOADS), help=f"subset dari {','.join(WORKLOADS)}")
+    ap.add_argument("--users", type=csv_ints, default=[1, 4, 16], help="jumlah user bersamaan, mis. 1,4,16")
+    ap.add_argument("--sizes", type=csv_ints, default=[1, 5, 20],
+                    help="ukuran korpus: hasil/pencarian, kelipatan prompt, PDF/upload, dokumen di index, sub-bab/naskah")
+    ap.add_argument("--ops", type=int, default=3, help="operasi per user per skenario")
+    ap.add_argument("--latency-ms", type=float, default=150, help="latensi dasar server & Gemini palsu")
+    ap.add_argument("--jitter-ms", type=float, default=100)
+    ap.add_argument("--rate-429", type=float, default=0.0, help="peluang respon 429 per request (0-1)")
+    ap.add_argument("--keys", type=int, default=4, help="jumlah API key palsu")
+    ap.add_argument("--rpm", type=int, default=0, help="KEY_RPM_BUDGET per key (0 = tanpa batas)")
+    ap.add_argument("--llm-workers", type=int, default=8, help="LLM_WORKERS antrian generate")
+    ap.add_argument("--user-concurrency", type=int, default=2, help="LLM_USER_CONCURRENCY per user")
+    ap.add_argument("--batch-concurrency", type=int, default=4, help="LLM_BATCH_CONCURRENCY per user")
+    ap.add_argument("--cooldown", type=float, default=2, help="KEY_COOLDOWN_SEC setelah 429")
+    ap.add_argument("--pdf-pages", type=int, default=10, help="halaman per PDF sintetis")
+    ap.add_argument("--search-oa-ft", action="store_true", help="pencarian dengan filter Open Access + Fulltext")
+    ap.add_argument("--search-repeat", type=float, default=0.0, help="porsi pencarian yang mengulang keyword (kena cache)")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--json", help="simpan hasil mentah ke file JSON (untuk dibandingkan antar versi)")
+    args = ap.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="thesis_bench_")
+    api = FakeApi(args.latency_ms, args.jitter_ms, args.rate_429, seed=args.seed)
+    httpd, base = api.serve()
+    fake_genai = FakeGenAI(args.latency_ms * 4, args.jitter_ms, args.rate_429, seed=args.seed)
+    app = load_app({"PUBMED_BASE_URL": base, "CROSSREF_URL": f"{base}/works", "CACHE_DIR": os.path.join(workdir, "cache"),
+                    "CORPUS_DIR": os.path.join(workdir, "corpus"), "METRICS_FILE": os.path.join(workdir, "metrics.jsonl"),
+                    "DB_FILE": os.path.join(workdir, "bench.db"), "KEY_RPM_BUDGET": args.rpm or 10**9,
+                    "KEY_COOLDOWN_SEC": args.cooldown, "LLM_WORKERS": args.llm_workers, "LLM_USER_CONCURRENCY": args.user_concurrency,
+                    "LLM_BATCH_CONCURRENCY": args.batch_concurrency, "API_KEYS_POOL": [f"bench-key-{i + 1}" for i in range(args.keys)],
+                    "genai": fake_genai, "glm": FakeGlm})
+
+    rng = random.Random(args.seed); rows = []
+    print(f"workdir: {workdir}\n")
+    head = f"{'workload':<11}{'size':>5}{'users':>6}{'ops':>6}{'err':>5}{'wall_s':>9}{'ops/s':>9}{'p50_ms':>9}{'p90_ms':>9}{'p99_ms':>9}"
+    print(head); print("-" * len(head))
+    for wl in [w.strip() for w in args.workloads.split(",") if w.strip()]:
+        if wl not in BENCHES: ap.error(f"workload tidak dikenal: {wl}")
+        for size in args.sizes:
+            for users in args.users:
+                res = BENCHES[wl](app, size, users, args, rng, f"{wl}{size}u{users}")
+                rows.append({"workload": wl, "size": size, "users": users, **res})
+                fmt = lambda v: "-" if v is None else f"{v:.1f}"
+                extra = f"  chunks={res['chunks']} build={res['index_build_ms']}ms" if "chunks" in res else ""
+                print(f"{wl:<11}{size:>5}{users:>6}{res['ops']:>6}{res['errors']:>5}{res['wall_s']:>9.2f}{fmt(res['ops_per_s']):>9}"
+                      f"{fmt(res['p50_ms']):>9}{fmt(res['p90_ms']):>9}{fmt(res['p99_ms']):>9}{extra}", flush=True)
+                if res["error_sample"]: print(f"{'':<11}contoh error: {res['error_sample']}")
+    httpd.shutdown()
+    print(f"\nrequest server palsu: {api.hits} | panggilan Gemini palsu: {fake_genai.calls}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": rows}, f, indent=1)
+    return rows
+
+if __name__ == "__main__":
+    main()
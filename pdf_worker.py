@@ -0,0 +1,19 @@
+"""Worker ekstraksi PDF untuk pool proses Ths.V6.py.
+
+Sengaja di modul terpisah: Streamlit mengganti modul `__main__` setiap rerun, jadi fungsi yang
+didefinisikan di skrip tidak bisa di-pickle ke worker setelah rerun pertama. Fungsi di sini selalu
+ditemukan lewat nama `pdf_worker.extract_pdf_pages`.
+"""
+import PyPDF2
+
+
+def extract_pdf_pages(path, start, end):
+    """Ekstrak halaman [start, end) satu per satu. PDF dibaca dari file sementara (xref + halaman
+    yang diminta saja), isinya tidak ikut di-pickle per task."""
+    out = []
+    with open(path, "rb") as fh:
+        reader = PyPDF2.PdfReader(fh)
+        for p in range(start, min(end, len(reader.pages))):
+            try: out.append((reader.pages[p].extract_text() or "") + "\n")
+            except: out.append("\n")
+    return out
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+from run_bench import load_app
+
+
+@pytest.fixture
+def store(tmp_path):
+    app = load_app({"DB_FILE": str(tmp_path / "t.db"), "METRICS_FILE": str(tmp_path / "m.jsonl")})
+    return app, app.ProjectStore(str(tmp_path / "t.db"))
+
+
+def save_all(store, key, values):
+    for v in values:
+        store.put("u", key, v); store.flush()
+
+
+def test_delta_roundtrip(store):
+    app, _ = store
+    old, new = "a\nb\nc\n", "a\nx\nc\nd\n"
+    assert app.apply_delta(new, app.text_delta(new, old)) == old
+    assert app.apply_delta("", app.text_delta("", old)) == old
+
+
+def test_history_across_reset(store):
+    _, s = store
+    save_all(s, "naskah_bab1", ["bab lama 1\nbab lama 2\n", "", "bab baru\n", "bab baru\nlagi\n"])
+    assert [t for _, t in s.history("u", "naskah_bab1")] == ["bab baru\n", "", "bab lama 1\nbab lama 2\n"]
+
+
+def test_history_across_delete(store):
+    _, s = store
+    save_all(s, "naskah_bab2", ["v1\n", "v2\n"])
+    s.clear("u"); s.flush()
+    save_all(s, "naskah_bab2", ["v3\n"])
+    assert [t for _, t in s.history("u", "naskah_bab2")] == ["", "v2\n", "v1\n"]